@@ -27,19 +27,19 @@ is_recording = False
 
 def output_text_to_input_field():
     while True:
-        if not text_queue.empty():
-            text = text_queue.get()
-            if text == SPEECH_START:
-                continue
-            elif text == SPEECH_END:
-                continue
-            else:
-                # 将识别的文本复制到剪贴板
-                pyperclip.copy(text)
-                print(text)
-                # 模拟 Ctrl+V 粘贴
-                keyboard.press_and_release('ctrl+v')
-        time.sleep(0.1)
+        text = text_queue.get()  # 阻塞等待识别结果
+        if text is None:
+            break  # 结束标志
+        if text == SPEECH_START:
+            continue
+        elif text == SPEECH_END:
+            continue
+        else:
+            # 将识别的文本复制到剪贴板
+            pyperclip.copy(text)
+            print(text)
+            # 模拟 Ctrl+V 粘贴
+            keyboard.press_and_release('ctrl+v')
 
 
 def main():
@@ -63,6 +63,8 @@ def main():
     except KeyboardInterrupt:
         print("正在停止语音输入...")
         stt.stop()
+        text_queue.put(None)
+        output_thread.join()
         print("语音输入已停止。")
 
 
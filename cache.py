@@ -0,0 +1,324 @@
+import os
+import json
+import time
+import hashlib
+import zlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+RESPONSE_CACHE_FILE = "response_cache.json"
+DEFAULT_MAX_ENTRIES = 128
+DEFAULT_TTL = 7 * 24 * 3600     # 秒
+SEMANTIC_THRESHOLD = 0.95       # 余弦相似度超过这个值视为同一个问题
+SAVE_DELAY = 5.0                # 写入后延迟保存（秒），连续几轮只重写一次文件
+OLLAMA_DEFAULT_TEMPERATURE = 0.8
+
+AUDIO_CACHE_FOLDER = "tts_cache"
+DEFAULT_AUDIO_CACHE_BYTES = 64 * 1024 * 1024
+AUDIO_CACHE_SUFFIX = ".wav.z"
+
+_file_digests = {}  # (path, mtime, size) -> sha256
+_file_digests_lock = threading.Lock()
+
+
+def file_digest(path):
+    """ 文件内容的 sha256，按修改时间和大小缓存；文件不存在返回 None """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    key = (path, stat.st_mtime, stat.st_size)
+    with _file_digests_lock:
+        digest = _file_digests.get(key)
+    if digest is None:
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                sha256.update(block)
+        digest = sha256.hexdigest()
+        with _file_digests_lock:
+            _file_digests[key] = digest
+    return digest
+
+
+class ResponseCache:
+    """
+        模型回复缓存，按 (模型 digest, 参数, 上下文, 提示词) 精确匹配，
+        可选按提示词 embedding 的相似度做语义匹配。按条数和 TTL 淘汰，保存在角色目录下。
+        上下文是本轮之前的对话历史和检索到的记忆，同样的 "继续" 在不同上下文中不会命中；
+        语义匹配也只在上下文相同的条目中进行，且精确匹配未命中时要先请求一次 embedding，
+        这次请求在首字的关键路径上。
+        温度大于 0 时回复不确定，默认不使用缓存（cache_nondeterministic=True 时仍然使用）。
+    """
+
+    def __init__(self, folder=None, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL,
+                 embedding_function=None, semantic_threshold=SEMANTIC_THRESHOLD,
+                 cache_nondeterministic=False):
+        self.path = os.path.join(
+            folder, RESPONSE_CACHE_FILE) if folder else None
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.embedding_function = embedding_function
+        self.semantic_threshold = semantic_threshold
+        self.cache_nondeterministic = cache_nondeterministic
+        self.entries = OrderedDict()  # key -> entry，按最近使用排序
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.save_timer = None
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.load()
+
+    @staticmethod
+    def make_scope(model_digest, options, context="") -> str:
+        data = json.dumps([model_digest, options or {}, context or ""],
+                          sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def make_key(scope, prompt) -> str:
+        return hashlib.sha256(f"{scope}\n{prompt}".encode("utf-8")).hexdigest()
+
+    def is_cacheable(self, options) -> bool:
+        temperature = (options or {}).get(
+            "temperature", OLLAMA_DEFAULT_TEMPERATURE)
+        return self.cache_nondeterministic or float(temperature) <= 0
+
+    def get(self, model_digest, options, prompt, context=""):
+        """ 命中返回缓存的回复，否则返回 None """
+        if not model_digest or not self.is_cacheable(options):
+            return None
+        scope = self.make_scope(model_digest, options, context)
+        key = self.make_key(scope, prompt)
+        with self.lock:
+            self.evict_expired()
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry["response"]
+
+        if self.embedding_function is not None:
+            embedding = self.embed(prompt)
+            if embedding is not None:
+                with self.lock:
+                    best_key, best_score = None, 0.0
+                    for entry_key, entry in self.entries.items():
+                        if entry["scope"] != scope or not entry.get("embedding"):
+                            continue
+                        score = float(
+                            np.dot(embedding, np.asarray(entry["embedding"])))
+                        if score > best_score:
+                            best_key, best_score = entry_key, score
+                    if best_key is not None and best_score >= self.semantic_threshold:
+                        self.entries.move_to_end(best_key)
+                        self.semantic_hits += 1
+                        return self.entries[best_key]["response"]
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, model_digest, options, prompt, response, context=""):
+        if not model_digest or not response or not self.is_cacheable(options):
+            return
+        scope = self.make_scope(model_digest, options, context)
+        entry = {
+            "scope": scope,
+            "prompt": prompt,
+            "response": response,
+            "time": time.time(),
+        }
+        if self.embedding_function is not None:
+            embedding = self.embed(prompt)
+            if embedding is not None:
+                entry["embedding"] = embedding.tolist()
+        key = self.make_key(scope, prompt)
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            self.evict_expired()
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        self.schedule_save()
+
+    def embed(self, prompt):
+        """ 归一化后的提示词向量，点积即余弦相似度 """
+        try:
+            embedding = np.asarray(
+                self.embedding_function.embed_query(prompt), dtype=np.float32)
+        except Exception as e:
+            print(f"Error embedding prompt for cache: {e}")
+            return None
+        norm = np.linalg.norm(embedding)
+        if embedding.size == 0 or norm == 0:
+            return None
+        return embedding / norm
+
+    def evict_expired(self):
+        if not self.ttl:
+            return
+        now = time.time()
+        expired = [key for key, entry in self.entries.items()
+                   if now - entry["time"] > self.ttl]
+        for key in expired:
+            del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        self.save()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+            self.entries = OrderedDict(entries)
+            self.evict_expired()
+        except Exception as e:
+            print(f"Error loading response cache {self.path}: {e}")
+            self.entries = OrderedDict()
+
+    def schedule_save(self):
+        """ 延迟 SAVE_DELAY 秒保存，期间的多次写入合并为一次 """
+        if not self.path:
+            return
+        with self.lock:
+            if self.save_timer is not None:
+                return
+            self.save_timer = threading.Timer(SAVE_DELAY, self.flush)
+            self.save_timer.daemon = True
+            self.save_timer.start()
+
+    def flush(self):
+        """ 立即保存尚未写入的修改，退出或切换角色时调用 """
+        with self.lock:
+            timer, self.save_timer = self.save_timer, None
+        if timer is None:
+            return
+        timer.cancel()
+        self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            data = dict(self.entries)
+        with self.save_lock:
+            try:
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(data, f, ensure_ascii=False)
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                print(f"Error saving response cache {self.path}: {e}")
+
+    def report(self) -> str:
+        return (f"Response cache: {len(self.entries)} entries, hits {self.hits}, "
+                f"semantic hits {self.semantic_hits}, misses {self.misses}")
+
+
+class AudioCache:
+    """
+        合成音频的磁盘缓存，文件名为请求参数的哈希，zlib 压缩后保存在角色目录的 tts_cache 下。
+        总大小超过 max_bytes 时按最近使用淘汰（文件修改时间即最近使用时间，重启后仍然有效）。
+    """
+
+    def __init__(self, folder, max_bytes=DEFAULT_AUDIO_CACHE_BYTES):
+        self.folder = os.path.join(folder, AUDIO_CACHE_FOLDER)
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> 文件大小，按最近使用排序
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.scan()
+
+    @staticmethod
+    def make_key(params) -> str:
+        data = json.dumps(params, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def get_path(self, key) -> str:
+        return os.path.join(self.folder, f"{key}{AUDIO_CACHE_SUFFIX}")
+
+    def scan(self):
+        if not os.path.isdir(self.folder):
+            return
+        files = []
+        for name in os.listdir(self.folder):
+            if not name.endswith(AUDIO_CACHE_SUFFIX):
+                continue
+            stat = os.stat(os.path.join(self.folder, name))
+            files.append((stat.st_mtime, name[:-len(AUDIO_CACHE_SUFFIX)], stat.st_size))
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.size += size
+
+    def get(self, key):
+        """ 命中返回 WAV 数据，否则返回 None """
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+        path = self.get_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = zlib.decompress(f.read())
+            os.utime(path)
+        except Exception as e:
+            print(f"Error reading audio cache {path}: {e}")
+            self.remove(key)
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return data
+
+    def put(self, key, data: bytes):
+        if not data:
+            return
+        compressed = zlib.compress(data)
+        if len(compressed) > self.max_bytes:
+            return
+        path = self.get_path(key)
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(compressed)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"Error writing audio cache {path}: {e}")
+            return
+        with self.lock:
+            self.size += len(compressed) - self.entries.get(key, 0)
+            self.entries[key] = len(compressed)
+            self.entries.move_to_end(key)
+            evicted = []
+            while self.size > self.max_bytes and self.entries:
+                old_key, old_size = self.entries.popitem(last=False)
+                self.size -= old_size
+                evicted.append(old_key)
+        for old_key in evicted:
+            try:
+                os.remove(self.get_path(old_key))
+            except OSError:
+                pass
+
+    def remove(self, key):
+        with self.lock:
+            self.size -= self.entries.pop(key, 0)
+        try:
+            os.remove(self.get_path(key))
+        except OSError:
+            pass
+
+    def report(self) -> str:
+        return (f"TTS cache: {len(self.entries)} clips, {self.size / 1024 / 1024:.1f}MB, "
+                f"hits {self.hits}, misses {self.misses}")
@@ -1,24 +1,454 @@
-import requests
+import os
+import json
+import sys
+import time
+import client
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
-ollama_base_url = "http://localhost:11434/api"
+try:
+    import orjson  # 可选，解析更快
+except ImportError:
+    orjson = None
+
+DEFAULT_NUM_CTX = 2048
+DEFAULT_NUM_PREDICT = 512  # 为回复预留的 token 数
+MESSAGE_OVERHEAD_TOKENS = 4  # 每条消息模板带来的额外 token
+TRIM_RATIO = 0.75  # 超出预算时一次裁剪到预算的 75%，减少前缀变化，提高 KV cache 命中
+
+# 流式分句（送入 TTS）
+FIRST_CHUNK_MIN_CHARS = 2   # 第一句尽量短，缩短首次出声时间
+FIRST_CHUNK_SOFT_CHARS = 10  # 第一句超过这个长度时，逗号也可以断句
+CHUNK_MIN_CHARS = 24        # 之后的句子太短就合并，摊薄 GPT-SoVITS 每次请求的开销
+CHUNK_MAX_CHARS = 120       # 一直没有标点时强制切分
+CJK_END_CHARS = "。！？；…～"
+LATIN_END_CHARS = ".!?;~"
+CLOSING_CHARS = "”’」』）)】》〉\"'"
+SOFT_BREAK_CHARS = "，、：,:"
+
+# 与 Ollama 服务端的 OLLAMA_NUM_PARALLEL 保持一致，超过也只会在服务端排队
+SUMMARY_PARALLEL = max(int(os.environ.get("OLLAMA_NUM_PARALLEL", "2") or 2), 1)
+SUMMARY_PROMPT_TOKENS = 256  # 摘要提示词本身的开销
+SUMMARY_MAX_LEVELS = 10  # 合并层数上限，防止估算偏差导致一直无法收敛
+
+STREAM_READ_SIZE = 16 * 1024  # 流式读取块大小，分块传输时每块到达即返回，不会等待凑满
+
+# 流式事件类型
+EVENT_TOKEN = "token"        # 生成的文本
+EVENT_PROGRESS = "progress"  # create/pull 等接口的进度
+EVENT_STATS = "stats"        # 最后一块中的耗时统计
+EVENT_DONE = "done"          # 结束，data 为最后一块的完整内容
+EVENT_ERROR = "error"
+
+StreamEvent = namedtuple("StreamEvent", ["type", "text", "data"])
+
+THINK_START_TAG = "<think>"
+THINK_END_TAG = "</think>"
 gpt_sovits_tts_url = "http://127.0.0.1:9880/tts"
 
 # True:仅将“”内台词生成语音，False:全部生成，（有bug =.=
 extract_dialogue_for_tts = False
 
 
-def generate_completion(prompt, model, stream=True):
-    url = f"{ollama_base_url}/generate"
+def generate_data(prompt, model, stream=True, options=None) -> dict:
+    """ /api/generate 的请求体，同步和异步请求共用 """
     data = {
         "model": model,
         "prompt": prompt,
-        "stream": stream
+        "stream": stream,
+        "keep_alive": client.KEEP_ALIVE
     }
-    headers = {"Content-Type": "application/json"}
-    response = requests.post(url, headers=headers, json=data, stream=stream)
+    if options:
+        data["options"] = options
+    return data
+
+
+def generate_completion(prompt, model, stream=True, options=None):
+    data = generate_data(prompt, model, stream, options)
+    response = client.post("generate", json=data, stream=stream)
     return response
 
 
+def warm_up(model, keep_alive=None) -> float:
+    """
+        预加载模型：不带 prompt 的 /api/generate 只加载模型，
+        之后第一条消息不再承担加载耗时。只加载时 Ollama 不返回 load_duration，返回实际耗时（毫秒）。
+    """
+    data = {
+        "model": model,
+        "keep_alive": client.KEEP_ALIVE if keep_alive is None else keep_alive,
+        "stream": False
+    }
+    start = time.perf_counter()
+    response = client.post("generate", json=data)
+    response.raise_for_status()
+    return (time.perf_counter() - start) * 1000
+
+
+def chat_data(messages, model, stream=True, options=None) -> dict:
+    """
+        /api/chat 多轮对话的请求体。messages 只在末尾追加，前缀保持不变，
+        Ollama 可以复用上一轮的 KV cache，只需评估新增的 token。
+    """
+    data = {
+        "model": model,
+        "messages": messages,
+        "stream": stream,
+        "keep_alive": client.KEEP_ALIVE
+    }
+    if options:
+        data["options"] = options
+    return data
+
+
+def get_response_text(json_data: dict) -> str:
+    """ 兼容 /api/generate 和 /api/chat 两种流式返回格式 """
+    if "response" in json_data:
+        return json_data["response"]
+    message = json_data.get("message")
+    if message:
+        return message.get("content", "")
+    return ""
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def get_stream_stats(json_data: dict) -> dict:
+    """ 最后一块里的统计信息，耗时由纳秒换算为毫秒 """
+    stats = {
+        "prompt_eval_count": json_data.get("prompt_eval_count", 0),
+        "prompt_eval_ms": json_data.get("prompt_eval_duration", 0) / 1e6,
+        "eval_count": json_data.get("eval_count", 0),
+        "eval_ms": json_data.get("eval_duration", 0) / 1e6,
+        "load_ms": json_data.get("load_duration", 0) / 1e6,
+        "total_ms": json_data.get("total_duration", 0) / 1e6,
+    }
+    stats["tokens_per_second"] = stats["eval_count"] * 1000 / \
+        stats["eval_ms"] if stats["eval_ms"] else 0.0
+    return stats
+
+
+def format_eval_stats(json_data: dict) -> str:
+    stats = get_stream_stats(json_data)
+    return (f"prompt_eval: {stats['prompt_eval_count']} tokens {stats['prompt_eval_ms']:.0f}ms, "
+            f"eval: {stats['eval_count']} tokens {stats['eval_ms']:.0f}ms "
+            f"({stats['tokens_per_second']:.1f} tokens/s), load: {stats['load_ms']:.0f}ms")
+
+
+def decode_stream_line(line):
+    """ 把 NDJSON 的一行解析为若干 StreamEvent，同步和异步流共用 """
+    try:
+        json_data = loads(line)
+    except ValueError:
+        print(f"JSON decoding error: {line}", file=sys.stderr)
+        return
+    if "error" in json_data:
+        yield StreamEvent(EVENT_ERROR, json_data["error"], json_data)
+        return
+    text = get_response_text(json_data)
+    if text:
+        yield StreamEvent(EVENT_TOKEN, text, json_data)
+    if "status" in json_data:
+        yield StreamEvent(EVENT_PROGRESS, json_data["status"], json_data)
+    if json_data.get("done", False):
+        if "eval_count" in json_data or "prompt_eval_count" in json_data:
+            yield StreamEvent(EVENT_STATS, format_eval_stats(json_data),
+                              get_stream_stats(json_data))
+        yield StreamEvent(EVENT_DONE, "", json_data)
+
+
+def iter_stream_events(response, read_size=STREAM_READ_SIZE):
+    """ 解析 Ollama 的 NDJSON 流（也兼容 stream=False 的单个 JSON） """
+    pending = b""
+    for block in response.iter_content(chunk_size=read_size):
+        if not block:
+            continue
+        lines = (pending + block).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield from decode_stream_line(line)
+    if pending.strip():
+        yield from decode_stream_line(pending)
+
+
+async def astream_events(path, data):
+    """ iter_stream_events 的异步版本，供对话引擎使用 """
+    async for line in client.astream_lines(path, json=data):
+        for event in decode_stream_line(line):
+            yield event
+
+
+def estimate_tokens(text: str) -> int:
+    """ 粗略估计 token 数：中日韩字符约 1 字 1 token，其他约 4 字符 1 token """
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if ch >= "\u2e80")
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+class ConversationHistory:
+    """
+        按轮次记录对话，维护 token 总数，超出 num_ctx 预算时从最早的消息开始裁剪。
+        每轮只对新消息估算一次 token，裁剪为均摊 O(1)，不再从界面文本框里回读历史。
+    """
+
+    def __init__(self, num_ctx=DEFAULT_NUM_CTX, reserve_tokens=DEFAULT_NUM_PREDICT):
+        self.num_ctx = int(num_ctx)
+        self.reserve_tokens = int(reserve_tokens)
+        self.turns = deque()  # (message, tokens)
+        self.total_tokens = 0
+
+    @classmethod
+    def from_character(cls, data: dict):
+        parameters = data.get("parameters", {})
+        num_ctx = parameters.get("num_ctx", DEFAULT_NUM_CTX)
+        num_predict = parameters.get("num_predict", DEFAULT_NUM_PREDICT)
+        if num_predict is None or int(num_predict) < 0:
+            num_predict = DEFAULT_NUM_PREDICT
+        # system 提示词（角色描述）同样占用上下文
+        reserve = int(num_predict) + \
+            estimate_tokens(data.get("description", ""))
+        return cls(num_ctx=num_ctx, reserve_tokens=reserve)
+
+    @property
+    def budget(self) -> int:
+        return max(self.num_ctx - self.reserve_tokens, 0)
+
+    def add(self, role: str, content: str) -> dict:
+        message = {"role": role, "content": content}
+        tokens = estimate_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+        self.turns.append((message, tokens))
+        self.total_tokens += tokens
+        if self.total_tokens > self.budget:
+            self.trim(int(self.budget * TRIM_RATIO))
+        return message
+
+    def trim(self, target_tokens: int):
+        # 至少保留最新的一条消息
+        while len(self.turns) > 1 and self.total_tokens > target_tokens:
+            _, tokens = self.turns.popleft()
+            self.total_tokens -= tokens
+        # 窗口以用户消息开头
+        while len(self.turns) > 1 and self.turns[0][0]["role"] != "user":
+            _, tokens = self.turns.popleft()
+            self.total_tokens -= tokens
+
+    def discard(self, message: dict):
+        """ 撤回最后追加的消息（例如本轮请求失败） """
+        if self.turns and self.turns[-1][0] is message:
+            _, tokens = self.turns.pop()
+            self.total_tokens -= tokens
+
+    def clear(self):
+        self.turns.clear()
+        self.total_tokens = 0
+
+    def window(self) -> list:
+        return [message for message, _ in self.turns]
+
+    def as_text(self, max_chars: int = None) -> str:
+        """ 拼成纯文本，供 /api/generate 的提示词使用，只取结尾 max_chars 个字符 """
+        lines = []
+        length = 0
+        for message, _ in reversed(self.turns):
+            line = f"{message['role']}: {message['content']}"
+            lines.append(line)
+            length += len(line) + 1
+            if max_chars and length >= max_chars:
+                break
+        text = "\n".join(reversed(lines))
+        if max_chars and len(text) > max_chars:
+            text = text[-max_chars:]
+        return text
+
+    def __len__(self):
+        return len(self.turns)
+
+
+class SentenceSegmenter:
+    """
+        流式分句器：每次 feed 只扫描新到的字符，返回可以送去合成的句子。
+        支持中日英标点、省略号、数字中的小数点和句末引号；
+        第一句尽量短以降低首次出声延迟，之后合并短句，过长时强制切分。
+    """
+
+    def __init__(self, first_min_chars=FIRST_CHUNK_MIN_CHARS, min_chars=CHUNK_MIN_CHARS,
+                 max_chars=CHUNK_MAX_CHARS, first_soft_chars=FIRST_CHUNK_SOFT_CHARS):
+        self.first_min_chars = first_min_chars
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.first_soft_chars = first_soft_chars
+        self.text = ""       # 尚未输出的文本
+        self.pos = 0         # 下一个待检查的字符
+        self.last_soft = 0   # 最近一个逗号类断点之后的位置
+        self.last_space = 0  # 最近一个空白之后的位置
+        self.chunk_count = 0
+
+    def reset(self):
+        self.text = ""
+        self.pos = 0
+        self.last_soft = 0
+        self.last_space = 0
+        self.chunk_count = 0
+
+    def feed(self, text: str) -> list:
+        self.text += text
+        chunks = []
+        while self.pos < len(self.text):
+            text = self.text
+            ch = text[self.pos]
+            end = self.boundary_end(text, self.pos)
+            if end == -1:
+                break  # 需要看到后面的字符才能判断
+            if end:
+                self.pos = end
+                if self.chunk_length(end) >= self.current_min_chars():
+                    chunks.append(self.emit(end))
+                continue
+            if ch in SOFT_BREAK_CHARS:
+                if ch in ",:" and self.pos + 1 == len(text):
+                    break  # 1,000 / 10:30 需要看下一个字符
+                if ch not in ",:" or not text[self.pos + 1].isdigit():
+                    self.last_soft = self.pos + 1
+                    if self.chunk_count == 0 and self.chunk_length(self.last_soft) >= self.first_soft_chars:
+                        self.pos += 1
+                        chunks.append(self.emit(self.pos))
+                        continue
+            elif ch.isspace():
+                self.last_space = self.pos + 1
+            self.pos += 1
+            if self.pos >= self.max_chars:
+                chunks.append(self.emit(self.force_split_end()))
+        return chunks
+
+    def force_split_end(self) -> int:
+        # 优先在逗号处切分，其次在空格处（避免切断英文单词），都没有就硬切
+        if self.last_soft >= self.min_chars:
+            return self.last_soft
+        if self.last_space >= self.min_chars:
+            return self.last_space
+        return self.pos
+
+    def flush(self) -> list:
+        """ 流结束时输出剩余文本 """
+        chunk = self.emit(len(self.text))
+        self.reset()
+        return [chunk] if chunk else []
+
+    def current_min_chars(self) -> int:
+        return self.first_min_chars if self.chunk_count == 0 else self.min_chars
+
+    def chunk_length(self, end: int) -> int:
+        return len(self.text[:end].strip())
+
+    def emit(self, end: int) -> str:
+        chunk = self.text[:end].strip()
+        self.text = self.text[end:]
+        self.pos = max(self.pos - end, 0)
+        self.last_soft = max(self.last_soft - end, 0)
+        self.last_space = max(self.last_space - end, 0)
+        if chunk:
+            self.chunk_count += 1
+        return chunk
+
+    @staticmethod
+    def boundary_end(text: str, i: int) -> int:
+        """
+            判断第 i 个字符是否是句末。返回句子结束的位置（含后面的引号），
+            0 表示不是句末，-1 表示需要更多字符才能判断。
+        """
+        ch = text[i]
+        if ch == "\n":
+            return i + 1
+        length = len(text)
+        if ch in CJK_END_CHARS:
+            j = i + 1
+            while j < length and (text[j] in CJK_END_CHARS or text[j] in LATIN_END_CHARS):
+                j += 1
+        elif ch in LATIN_END_CHARS:
+            j = i + 1
+            while j < length and text[j] in LATIN_END_CHARS:
+                j += 1  # ... / ?! / ~~
+            if j == length:
+                return -1
+            if ch == "." and j == i + 1 and text[j].isdigit():
+                return 0  # 3.14
+        else:
+            return 0
+        while j < length and text[j] in CLOSING_CHARS:
+            j += 1
+        if j == length:
+            return -1
+        nxt = text[j]
+        if ch in CJK_END_CHARS or nxt.isspace() or not nxt.isascii():
+            return j
+        return 0  # e.g. "e.g" / "file.txt"
+
+    def __len__(self):
+        return len(self.text)
+
+
+class ThinkTagParser:
+    """
+        推理模型（qwen3/deepseek-r1）流式输出的 <think>...</think> 解析器。
+        推理内容和回答内容分别交给 on_think/on_answer，标签被拆在多个块里也能正确识别，
+        只处理新到的文本，整体线性时间。
+    """
+
+    def __init__(self, on_think=None, on_answer=None):
+        self.on_think = on_think
+        self.on_answer = on_answer
+        self.in_think = False
+        self.pending = ""  # 结尾处可能是半个标签，等下一块再判断
+
+    def feed(self, text: str):
+        """ 返回 (think_text, answer_text) """
+        text = self.pending + text
+        self.pending = ""
+        think, answer = [], []
+        i = 0
+        while i < len(text):
+            tag = THINK_END_TAG if self.in_think else THINK_START_TAG
+            sink = think if self.in_think else answer
+            j = text.find(tag, i)
+            if j == -1:
+                keep = self.partial_tag_length(text, tag, i)
+                sink.append(text[i:len(text) - keep])
+                self.pending = text[len(text) - keep:]
+                break
+            sink.append(text[i:j])
+            i = j + len(tag)
+            self.in_think = not self.in_think
+        return self.dispatch("".join(think), "".join(answer))
+
+    def flush(self):
+        """ 流结束时输出残留的半个标签 """
+        text, self.pending = self.pending, ""
+        if self.in_think:
+            return self.dispatch(text, "")
+        return self.dispatch("", text)
+
+    def dispatch(self, think: str, answer: str):
+        if think and self.on_think:
+            self.on_think(think)
+        if answer and self.on_answer:
+            self.on_answer(answer)
+        return think, answer
+
+    @staticmethod
+    def partial_tag_length(text: str, tag: str, start: int) -> int:
+        """ text 结尾与 tag 前缀重合的最大长度 """
+        for k in range(min(len(tag) - 1, len(text) - start), 0, -1):
+            if text.endswith(tag[:k]):
+                return k
+        return 0
+
+
 def generate_summary_prompt(content):
     prompt = f"""
     As who you are, please write a memo summarizing the given text. Focus on listing the key points and highlighting the main truths. If there are dialogues, retain the roles and their lines for easy reference. Ensure no information is omitted and record the details as thoroughly as possible.
@@ -31,6 +461,132 @@ def generate_summary_prompt(content):
     return prompt
 
 
+def generate_memory_prompt(user_input, relevant_documents):
+    # 对话历史已经在 messages 里，这里只拼接检索到的文档
+    prompt = f"""
+    Here are some relevant documents that may be useful for your response. If there is any irrelevant or inaccurate information in them, please disregard it.
+
+    Relevant Documents:
+    {relevant_documents}
+
+    User's Input:
+    {user_input}
+    """
+    return prompt
+
+
+def generate_combine_summary_prompt(summaries):
+    joined = "\n\n".join(summaries)
+    prompt = f"""
+    As who you are, the following memos summarize consecutive parts of one text. Merge them into a single memo. Keep the key points, the main truths, the roles and their important lines, remove repetitions and keep the original order.
+
+    Memos:
+    {joined}
+
+    Summary:
+    """
+    return prompt
+
+
+def complete(prompt, model, options=None) -> str:
+    """ 非流式生成，返回完整文本 """
+    response = generate_completion(
+        prompt, model=model, stream=False, options=options)
+    response.raise_for_status()
+    text = ""
+    for event in iter_stream_events(response):
+        if event.type == EVENT_TOKEN:
+            text += event.text
+        elif event.type == EVENT_ERROR:
+            raise RuntimeError(event.text)
+    return text.strip()
+
+
+def group_chunks(chunks, max_tokens):
+    """ 把相邻的文本块合并为不超过 max_tokens 的组 """
+    groups, current, current_tokens = [], [], 0
+    for chunk in chunks:
+        tokens = estimate_tokens(chunk)
+        if current and current_tokens + tokens > max_tokens:
+            groups.append("\n".join(current))
+            current, current_tokens = [], 0
+        current.append(chunk)
+        current_tokens += tokens
+    if current:
+        groups.append("\n".join(current))
+    return groups
+
+
+def group_summaries(summaries, max_tokens):
+    """
+        合并层的分组。没有两个相邻摘要能放进同一组时两两合并；
+        两两合并仍超出预算的拆开，各自单独再压缩一次，下一层再合并
+    """
+    groups = group_chunks(summaries, max_tokens)
+    if len(groups) < len(summaries):
+        return groups
+    groups = []
+    for i in range(0, len(summaries), 2):
+        pair = summaries[i:i + 2]
+        if len(pair) == 2 and estimate_tokens("\n\n".join(pair)) > max_tokens:
+            groups.extend(pair)
+        else:
+            groups.append("\n\n".join(pair))
+    return groups
+
+
+def summarize(content, model, split_text, num_ctx=DEFAULT_NUM_CTX, num_predict=DEFAULT_NUM_PREDICT,
+              max_workers=SUMMARY_PARALLEL, on_progress=None) -> str:
+    """
+        map-reduce 摘要：超过上下文预算的文本先用 split_text 分块并发摘要（并发数与
+        OLLAMA_NUM_PARALLEL 一致），再把各块摘要逐层合并，避免长文本被静默截断。
+        on_progress(done, total, level) 在每完成一块时调用。
+    """
+    num_ctx = int(num_ctx or DEFAULT_NUM_CTX)
+    num_predict = int(num_predict or 0)
+    if num_predict <= 0:
+        num_predict = DEFAULT_NUM_PREDICT  # -1/-2 不限长度，预算无法估计，按默认值限制
+    budget = max(num_ctx - num_predict - SUMMARY_PROMPT_TOKENS, 256)
+    # 每个摘要最多占预算的一半，任意两个摘要都能放进一次合并请求，合并才会收敛
+    options = {"num_predict": min(num_predict, budget // 2)}
+    if estimate_tokens(content) <= budget:
+        if on_progress:
+            on_progress(0, 1, 0)
+        summary = complete(generate_summary_prompt(content), model, options)
+        if on_progress:
+            on_progress(1, 1, 0)
+        return summary
+
+    groups = group_chunks(split_text(content), budget)
+    level = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # map：各块分别摘要
+        summaries = run_summaries(
+            executor, [generate_summary_prompt(group) for group in groups], model, options, level, on_progress)
+        # reduce：逐层合并，直到能放进一次请求
+        while len(summaries) > 1:
+            level += 1
+            if level > SUMMARY_MAX_LEVELS:
+                raise RuntimeError(
+                    f"Summary did not converge after {SUMMARY_MAX_LEVELS} merge levels")
+            groups = group_summaries(summaries, budget)
+            summaries = run_summaries(
+                executor, [generate_combine_summary_prompt([group]) for group in groups], model, options, level,
+                on_progress)
+    return summaries[0] if summaries else ""
+
+
+def run_summaries(executor, prompts, model, options, level, on_progress=None):
+    futures = [executor.submit(complete, prompt, model, options)
+               for prompt in prompts]
+    results = []
+    for i, future in enumerate(futures):
+        results.append(future.result())
+        if on_progress:
+            on_progress(i + 1, len(futures), level)
+    return results
+
+
 def generate_contextual_prompt(user_input, relevant_documents, conversation_history):
 
     prompt = f"""
@@ -0,0 +1,141 @@
+import threading
+import weakref
+import asyncio
+import requests
+from requests.adapters import HTTPAdapter
+
+ollama_host = "http://localhost:11434"
+ollama_base_url = f"{ollama_host}/api"
+
+CONNECT_TIMEOUT = 3.05  # 建立连接的超时（秒）
+READ_TIMEOUT = 300      # 读取超时（秒），模型首次加载、长回复可能较慢
+POOL_SIZE = 8           # 每个 host 保持的长连接数量
+KEEP_ALIVE = "30m"      # 模型空闲多久后由 Ollama 卸载，-1 为常驻
+
+_lock = threading.Lock()
+_session = None
+_ollama_client = None
+_async_clients = weakref.WeakKeyDictionary()  # 每个事件循环一个 AsyncClient
+
+
+def configure(host=None, connect_timeout=None, read_timeout=None, pool_size=None, keep_alive=None):
+    """ 修改连接参数，已创建的连接池会被关闭并在下次调用时按新参数重建 """
+    global ollama_host, ollama_base_url, CONNECT_TIMEOUT, READ_TIMEOUT, POOL_SIZE, KEEP_ALIVE
+    if keep_alive is not None:
+        KEEP_ALIVE = keep_alive
+    if host:
+        ollama_host = host.rstrip("/")
+        ollama_base_url = f"{ollama_host}/api"
+    if connect_timeout:
+        CONNECT_TIMEOUT = float(connect_timeout)
+    if read_timeout:
+        READ_TIMEOUT = float(read_timeout)
+    if pool_size:
+        POOL_SIZE = int(pool_size)
+    close()
+
+
+def get_timeout(timeout=None):
+    if timeout is None:
+        return (CONNECT_TIMEOUT, READ_TIMEOUT)
+    return timeout
+
+
+def get_url(path: str) -> str:
+    if path.startswith("http://") or path.startswith("https://"):
+        return path
+    return f"{ollama_base_url}/{path.lstrip('/')}"
+
+
+def get_session() -> requests.Session:
+    """ 进程内共享的 keep-alive 会话，所有同步请求复用同一个连接池 """
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers.update({"Content-Type": "application/json"})
+                _session = session
+    return _session
+
+
+def post(path: str, json=None, stream=False, timeout=None) -> requests.Response:
+    return get_session().post(get_url(path), json=json, stream=stream,
+                              timeout=get_timeout(timeout))
+
+
+def get(path: str, params=None, stream=False, timeout=None) -> requests.Response:
+    return get_session().get(get_url(path), params=params, stream=stream,
+                             timeout=get_timeout(timeout))
+
+
+def get_ollama_client():
+    """ 共享的 ollama.Client，用于模型管理（list/create/...） """
+    global _ollama_client
+    if _ollama_client is None:
+        with _lock:
+            if _ollama_client is None:
+                import ollama
+                _ollama_client = ollama.Client(
+                    host=ollama_host, timeout=READ_TIMEOUT)
+    return _ollama_client
+
+
+def get_async_client():
+    """ 当前事件循环共享的 httpx.AsyncClient（httpx 随 ollama 包一起安装） """
+    import httpx
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=POOL_SIZE,
+                                max_keepalive_connections=POOL_SIZE),
+            headers={"Content-Type": "application/json"})
+        _async_clients[loop] = client
+    return client
+
+
+async def apost(path: str, json=None, timeout=None):
+    client = get_async_client()
+    kwargs = {} if timeout is None else {"timeout": timeout}
+    return await client.post(get_url(path), json=json, **kwargs)
+
+
+async def aget(path: str, params=None, timeout=None):
+    client = get_async_client()
+    kwargs = {} if timeout is None else {"timeout": timeout}
+    return await client.get(get_url(path), params=params, **kwargs)
+
+
+async def astream_lines(path: str, json=None):
+    """ 以流的方式 POST，逐行产出响应内容（NDJSON） """
+    client = get_async_client()
+    async with client.stream("POST", get_url(path), json=json) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if line:
+                yield line
+
+
+async def aclose():
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    client = _async_clients.pop(loop, None)
+    if client is not None:
+        await client.aclose()
+
+
+def close():
+    global _session, _ollama_client
+    with _lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+        _ollama_client = None
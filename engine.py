@@ -0,0 +1,340 @@
+import asyncio
+import itertools
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import chat
+import client
+import mem
+import pipeline
+import residency
+from stt import SPEECH_START, SPEECH_END
+
+ENGINE_WORKERS = 4       # 阻塞操作（缓存读写等）使用的线程数
+TOKEN_TIMEOUT = 60       # 生成中途两次输出之间的最长等待（秒），首个输出按 client.READ_TIMEOUT 等待模型加载
+RETRIEVAL_TIMEOUT = 15   # 等待记忆检索结果的最长时间（秒）
+STOP_TIMEOUT = 5
+
+
+class Turn:
+    """ 一轮对话的上下文：输入、取消令牌、已生成的回复和首字耗时，只在引擎的事件循环中修改 """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, user_input):
+        self.id = next(self._ids)
+        self.user_input = user_input
+        self.prompt = user_input.strip()
+        self.token = pipeline.CancelToken()  # 交给 TTS，打断时丢弃这一轮待合成的句子
+        self.task = None
+        self.history = None  # 开始时的对话历史，切换角色后仍写回原来的历史
+        self.message = None  # 已加入历史的用户消息，没有得到回复时撤回
+        self.context = ""  # 本轮之前的历史和检索结果，回复缓存按它区分
+        self.answer = ""
+        self.started = time.perf_counter()
+        self.first_token_ms = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.token.cancelled
+
+    @property
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+
+class ConversationEngine:
+    """
+        对话引擎：在后台线程的事件循环中运行，每轮对话是一个 asyncio 任务。
+        新一轮开始或打断时取消上一轮的任务并等它收尾（写回历史）后再继续，LLM 流随任务取消立即关闭。
+        识别、合成、播放仍由各自的线程完成，引擎只负责编排：录音和播放回调是实时的，
+        Whisper 和 GPT-SoVITS 请求是长时间阻塞的调用，放进事件循环也只能各占一个执行器线程，
+        它们之间已经由有界队列和每轮的 CancelToken 连接，打断时同样立即生效。
+        界面通过 app 的回调显示结果：
+        on_speech_start/on_recognized/on_speech_end、on_reply_start/on_reply/on_turn_error/on_turn_end，
+        以及 speak、take_memory、get_cached_response/put_cached_response。
+    """
+
+    def __init__(self, app, stt_queue=None):
+        self.app = app
+        self.stt_queue = stt_queue
+        self.loop = None
+        self.thread = None
+        self.listen_thread = None
+        self.executor = ThreadPoolExecutor(
+            max_workers=ENGINE_WORKERS, thread_name_prefix="engine")
+        # TTS 文本队列满时 put 会阻塞，句子按顺序交给单独的线程，不占用事件循环
+        self.speech_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="engine-speak")
+        self.turn = None
+        self.lock = threading.Lock()
+        self.turns = 0
+        self.cancelled_turns = 0
+        self.timeouts = 0
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.run_loop, daemon=True, name="engine")
+        self.thread.start()
+        if self.stt_queue is not None:
+            self.listen_thread = threading.Thread(
+                target=self.listen, daemon=True, name="engine-stt")
+            self.listen_thread.start()
+
+    def run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+        self.loop.close()
+
+    def stop(self):
+        if self.loop is None:
+            return
+        if self.listen_thread is not None:
+            self.stt_queue.put(None)  # 唤醒 listen
+            self.listen_thread.join()
+            self.listen_thread = None
+        future = asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop)
+        try:
+            future.result(STOP_TIMEOUT)
+        except Exception as e:
+            print(f"Error stopping engine: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.executor.shutdown(wait=False)
+        self.speech_executor.shutdown(wait=False)
+        self.loop = None
+
+    async def shutdown(self):
+        turn = self.turn
+        if turn is not None:
+            await self.cancel_turn(turn)
+        await client.aclose()
+
+    def submit(self, user_input) -> Turn:
+        """ 任意线程调用：开始新的一轮，同时打断上一轮 """
+        turn = Turn(user_input)
+        with self.lock:
+            previous, self.turn = self.turn, turn
+        if previous is not None:
+            previous.token.cancel()  # 立即生效，TTS 不再接收上一轮的句子
+        asyncio.run_coroutine_threadsafe(self.run_turn(turn, previous), self.loop)
+        return turn
+
+    def cancel(self):
+        """ 任意线程调用：打断当前一轮（barge-in） """
+        with self.lock:
+            turn = self.turn  # 保留到任务收尾，下一轮开始前会等它结束
+        if turn is None:
+            return
+        turn.token.cancel()
+        self.loop.call_soon_threadsafe(self.cancel_task, turn)
+
+    def cancel_task(self, turn):
+        if turn.task is not None:
+            turn.task.cancel()
+
+    async def cancel_turn(self, turn):
+        """ 取消一轮并等它执行完 finally，保证历史按轮次顺序写入 """
+        turn.token.cancel()
+        if turn.task is not None and turn.task is not asyncio.current_task():
+            turn.task.cancel()
+            await asyncio.wait([turn.task])
+
+    @staticmethod
+    def check_cancelled(turn):
+        """
+            每次 await 之后检查令牌：Python 3.11 及以前 wait_for 内部的操作恰好完成时会丢掉取消请求，
+            不能只依赖 task.cancel()
+        """
+        if turn.cancelled:
+            raise asyncio.CancelledError()
+
+    def speak(self, turn, sentence):
+        """ 不等待：被打断后还没执行的句子由 TTS 按令牌丢弃 """
+        self.speech_executor.submit(self.app.speak, sentence, turn.token)
+
+    async def run_blocking(self, func, *args):
+        return await self.loop.run_in_executor(self.executor, func, *args)
+
+    def listen(self):
+        """ 在守护线程中阻塞等待识别结果，交给事件循环处理，关闭窗口时不会阻止进程退出 """
+        while True:
+            item = self.stt_queue.get()
+            if item is None:
+                break  # 结束标志
+            self.loop.call_soon_threadsafe(self.on_stt_item, item)
+
+    def on_stt_item(self, item):
+        if item == SPEECH_START:
+            self.app.on_speech_start()
+        elif item == SPEECH_END:
+            self.app.on_speech_end()
+        else:
+            self.app.on_recognized(item)
+
+    async def run_turn(self, turn, previous):
+        turn.task = asyncio.current_task()
+        self.turns += 1
+        try:
+            if previous is not None:
+                await self.cancel_turn(previous)
+            self.check_cancelled(turn)  # 开始前已被打断，也要经过 finish 收尾
+            await self.respond(turn)
+        except asyncio.CancelledError:
+            pass  # 被打断，收尾在 finally 中完成
+        except Exception as e:
+            if not turn.cancelled:  # 打断时关闭连接引发的异常不算错误
+                if isinstance(e, asyncio.TimeoutError):
+                    self.timeouts += 1
+                print("message send failed!", str(e))
+                self.app.on_turn_error(turn, e)
+        finally:
+            self.finish(turn)
+
+    async def respond(self, turn):
+        app = self.app
+        # 识别/发送时已经开始检索，这里只取结果
+        retrieval = app.take_memory(str(turn.user_input))
+        history = turn.history = app.history
+        model = app.character['name']
+        relevant_documents_str = ""
+        if app.reuse_context:
+            # /api/chat: 历史在 history 中，只追加本轮输入
+            if retrieval is not None:
+                relevant_documents_str = await self.wait_memory(retrieval)
+                self.check_cancelled(turn)
+            turn.message = history.add("user", turn.prompt)
+            messages = history.window()
+            context = messages[:-1]
+            if retrieval is not None:
+                # 检索到的记忆只随本轮发送，历史中保存原始输入：
+                # 之后各轮的前缀保持不变（KV cache 命中），旧的记忆也不会挤占上下文
+                messages = context + [{"role": "user", "content": chat.generate_memory_prompt(
+                    user_input=turn.user_input, relevant_documents=relevant_documents_str)}]
+            path, data = "chat", chat.chat_data(messages, model)
+        else:
+            conversation_history_str = history.as_text(max_chars=mem.CHUNK_SIZE)
+            turn.message = history.add("user", turn.prompt)
+            prompt = turn.prompt
+            if retrieval is not None and conversation_history_str:
+                relevant_documents_str = await self.wait_memory(retrieval)
+                self.check_cancelled(turn)
+                prompt = chat.generate_contextual_prompt(
+                    user_input=turn.user_input, conversation_history=conversation_history_str,
+                    relevant_documents=relevant_documents_str)
+            context = conversation_history_str
+            path, data = "generate", chat.generate_data(prompt, model)
+
+        # 缓存按本轮之前的历史和检索结果区分，只有发给模型的内容相同时才会命中
+        turn.context = json.dumps([context, relevant_documents_str], ensure_ascii=False)
+        cached = await self.run_blocking(
+            app.get_cached_response, turn.prompt, turn.context)
+        self.check_cancelled(turn)
+        if cached is not None:
+            self.replay(turn, cached)
+            return
+        await self.stream_reply(turn, path, data)
+
+    async def wait_memory(self, future) -> str:
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), RETRIEVAL_TIMEOUT)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Error querying memory: {e}")
+            return ""
+
+    async def stream_reply(self, turn, path, data):
+        app = self.app
+        segmenter = chat.SentenceSegmenter()
+
+        def on_answer(answer_part):
+            if turn.cancelled:
+                return  # 已打断：不再显示，避免出现在下一轮的 "You:" 之后
+            if not turn.answer:
+                answer_part = answer_part.lstrip()  # </think> 后的空行
+            if not answer_part:
+                return
+            turn.answer += answer_part
+            sentences = segmenter.feed(answer_part)
+            app.on_reply(answer_part, see=bool(sentences))
+            for sentence in sentences:
+                self.speak(turn, sentence)
+
+        # 推理内容只打印到控制台，回答内容显示并送去合成
+        think_parser = chat.ThinkTagParser(
+            on_think=lambda text: print(text, flush=True, end=''),
+            on_answer=on_answer)
+        events = chat.astream_events(path, data)
+        try:
+            timeout = client.READ_TIMEOUT  # 首个输出可能要等模型加载
+            while True:
+                try:
+                    event = await asyncio.wait_for(events.__anext__(), timeout)
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    raise asyncio.TimeoutError(f"no output from /api/{path} for {timeout}s")
+                self.check_cancelled(turn)
+                if turn.first_token_ms is None:
+                    turn.first_token_ms = turn.elapsed_ms
+                    app.on_reply_start(turn)
+                    timeout = TOKEN_TIMEOUT
+                if event.type == chat.EVENT_TOKEN:
+                    think_parser.feed(event.text)
+                elif event.type == chat.EVENT_STATS:
+                    # 对比两种模式的 prompt_eval 耗时
+                    print(f"[{path}] {event.text}")
+                    # 判断换出时可能请求 /api/ps，不在事件循环中等待
+                    self.executor.submit(
+                        residency.planner.record_load, data["model"], event.data["load_ms"])
+                elif event.type == chat.EVENT_ERROR:
+                    raise RuntimeError(event.text)
+                elif event.type == chat.EVENT_DONE:
+                    think_parser.flush()
+                    for sentence in segmenter.flush():
+                        self.speak(turn, sentence)
+                    app.on_reply("", see=True)
+                    if turn.message is not None:
+                        turn.history.add("assistant", turn.answer)
+                        turn.message = None
+                        # 写缓存可能要请求 embedding，放到最后一句送去合成之后，不等待
+                        self.executor.submit(
+                            app.put_cached_response, turn.prompt, turn.answer, turn.context)
+                    break
+        finally:
+            await events.aclose()  # 关闭 HTTP 流
+
+    def replay(self, turn, answer):
+        """ 命中回复缓存：不请求模型，直接显示并朗读；用户消息已经加入历史 """
+        turn.history.add("assistant", answer)
+        turn.message = None
+        turn.answer = answer
+        turn.first_token_ms = turn.elapsed_ms
+        self.app.on_reply_start(turn)
+        self.app.on_reply(answer, see=True)
+        segmenter = chat.SentenceSegmenter()
+        for sentence in segmenter.feed(answer) + segmenter.flush():
+            self.speak(turn, sentence)
+
+    def finish(self, turn):
+        if turn.cancelled:
+            self.cancelled_turns += 1
+        if turn.message is not None:
+            if turn.cancelled and turn.answer:
+                # 被打断：保留已经生成（大多已播放）的部分回复
+                turn.history.add("assistant", turn.answer)
+            else:
+                # 本轮没有得到完整回复，撤回用户消息，保持 messages 前缀一致
+                turn.history.discard(turn.message)
+            turn.message = None
+        with self.lock:
+            if self.turn is turn:
+                self.turn = None
+        self.app.on_turn_end(turn)
+
+    def report(self) -> str:
+        return (f"Engine: {self.turns} turns, cancelled {self.cancelled_turns}, "
+                f"timeouts {self.timeouts}")
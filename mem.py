@@ -7,6 +7,9 @@ from langchain_chroma import Chroma
 import requests
 from typing import List
 import uuid
+import time
+import client
+import residency
 import ollama as ollama
 import json
 from typing import (
@@ -22,7 +25,9 @@ CHUNK_SIZE = 1024    # 每个块的大小
 CHUNK_OVERLAP = 64   # 块之间的重叠大小
 QUERY_K = 4
 DEFAULT_EMBEDDING_MODEL = "bge-m3"  # or "nomic-embed-text"
-DEFAULT_EMBEDDING_URL = "http://localhost:11434/api/embeddings"
+DEFAULT_EMBEDDING_URL = "embed"  # 相对 client.ollama_base_url，也可填完整 URL
+EMBEDDING_TIMEOUT = 10
+EMBEDDING_BATCH_SIZE = 32  # 写入记忆时每次请求的文本段数
 
 # 初始化文本分割器
 text_splitter = RecursiveCharacterTextSplitter(
@@ -39,27 +44,45 @@ class OllamaEmbeddingFunction:
         self.base_url = base_url
 
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        # 批量请求，一次 /api/embed 处理多段文本
         embeddings = []
-        for text in texts:
-            embedding = self.embed_query(text)
-            embeddings.append(embedding)
+        for i in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+            batch = texts[i:i + EMBEDDING_BATCH_SIZE]
+            result = self.embed(batch)
+            if len(result) != len(batch):
+                result = [[] for _ in batch]
+            embeddings.extend(result)
         return embeddings
 
     def embed_query(self, query: str) -> List[float]:
+        embeddings = self.embed([query])
+        return embeddings[0] if embeddings else []
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        response = None
         try:
-            response = requests.post(
+            data = {"model": self.model_name,
+                    "input": texts,
+                    "keep_alive": client.KEEP_ALIVE}
+            options = residency.planner.embedding_options()
+            if options:
+                data["options"] = options
+            response = client.post(
                 self.base_url,
-                json={"model": self.model_name,
-                      "prompt": query},  # 发送单个 prompt
-                timeout=10
+                json=data,
+                # 批量时按文本段数放宽读取超时
+                timeout=(client.CONNECT_TIMEOUT, EMBEDDING_TIMEOUT + len(texts))
             )
             # response = ollama.embed(model=self.model_name, input=query)
             response.raise_for_status()
             data = response.json()
-            embedding = data.get("embedding")
+            residency.planner.record_load(
+                self.model_name, data.get("load_duration", 0) / 1e6)
+            embeddings = data.get("embeddings")
             # 检查 embedding 存在且格式正确
-            if embedding and isinstance(embedding, list) and all(isinstance(x, (int, float)) for x in embedding):
-                return embedding
+            if embeddings and isinstance(embeddings, list) and all(
+                    isinstance(embedding, list) and all(isinstance(x, (int, float)) for x in embedding) for embedding in embeddings):
+                return embeddings
             else:
                 print("Ollama 没有返回 embedding 或返回的格式不正确。")
                 print("Ollama 返回的 JSON:", data)  # 打印完整的 JSON 响应，方便调试
@@ -67,11 +90,27 @@ class OllamaEmbeddingFunction:
         except requests.exceptions.RequestException as e:
             print(f"连接 Ollama 出错: {e}")
             return []
-        except (KeyError, TypeError) as e:
-            print(f"处理 Ollama 响应出错: {e}, 响应内容: {response.text}")  # 打印响应内容
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"处理 Ollama 响应出错: {e}, 响应内容: {response.text if response is not None else ''}")  # 打印响应内容
             return []
 
 
+def warm_up_embedding(model_name=DEFAULT_EMBEDDING_MODEL, keep_alive=None) -> float:
+    """ 预加载 embedding 模型，空输入时 Ollama 不返回 load_duration，返回实际耗时（毫秒） """
+    start = time.perf_counter()
+    data = {"model": model_name,
+            "input": "",  # 空输入只加载模型
+            "keep_alive": client.KEEP_ALIVE if keep_alive is None else keep_alive}
+    options = residency.planner.embedding_options()
+    if options:
+        data["options"] = options
+    response = client.post(DEFAULT_EMBEDDING_URL, json=data,
+                           timeout=(client.CONNECT_TIMEOUT, client.READ_TIMEOUT))
+    response.raise_for_status()
+    residency.planner.mark_loaded(model_name)
+    return (time.perf_counter() - start) * 1000
+
+
 def get_store_path(folder_name: str) -> str:
     return os.path.join(folder_name, vector_store_path)
 
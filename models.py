@@ -0,0 +1,173 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import client
+import chat
+
+BUILD_DIGEST_FILE = "model_build.json"  # 保存在角色目录下：模型名 -> 构建时的 Modelfile 摘要
+PROGRESS_STEP = 10  # 下载等带进度的状态每 10% 输出一次
+INVENTORY_TTL = 30  # 已安装模型列表的缓存时间（秒），命令行里 pull/rm 后最多延迟这么久生效
+
+
+def modelfile_digest(from_model, parameters, template, system) -> str:
+    """ 角色模型定义 (from, parameters, template, system) 的摘要，不变则不需要重新构建 """
+    data = json.dumps([from_model, parameters or {}, template or "", system or ""],
+                      sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def load_build_digest(folder, model_name):
+    if not folder:
+        return None
+    path = os.path.join(folder, BUILD_DIGEST_FILE)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f).get(model_name)
+    except Exception as e:
+        print(f"Error loading build digest {path}: {e}")
+        return None
+
+
+def save_build_digest(folder, model_name, digest):
+    if not folder:
+        return
+    path = os.path.join(folder, BUILD_DIGEST_FILE)
+    try:
+        data = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        data[model_name] = digest
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        print(f"Error saving build digest {path}: {e}")
+
+
+class ModelInventory:
+    """
+        已安装模型列表（/api/tags）的缓存，TTL 内的存在性检查、列表和 digest 查询不再请求服务器。
+        通过本程序 create 模型后调用 invalidate()，下次查询时重新获取。
+    """
+
+    def __init__(self, ttl=INVENTORY_TTL):
+        self.ttl = ttl
+        self.models = None
+        self.updated = 0.0
+        self.refresh_count = 0
+        self.lock = threading.Lock()
+
+    def list(self, force=False):
+        """ 已安装的模型列表（ollama.ListResponse.models） """
+        with self.lock:
+            if not force and self.models is not None and time.time() - self.updated < self.ttl:
+                return self.models
+        models = client.get_ollama_client().list().models
+        with self.lock:
+            self.models = models
+            self.updated = time.time()
+            self.refresh_count += 1
+        return models
+
+    def find(self, model_name):
+        return find_model(self.list(), model_name)
+
+    def exists(self, model_name) -> bool:
+        return self.find(model_name) is not None
+
+    def digest(self, model_name):
+        """ 模型的 digest，重新构建后会变化，可作为其他缓存的 key """
+        model = self.find(model_name)
+        return model.digest if model is not None else None
+
+    def sizes(self) -> dict:
+        """ 模型名 -> 文件大小（字节） """
+        return {model.model: model.size or 0 for model in self.list()}
+
+    def invalidate(self):
+        with self.lock:
+            self.models = None
+
+    def report(self) -> str:
+        return f"Model inventory: {len(self.models or [])} models, refreshed {self.refresh_count} times"
+
+
+def list_models(force=False):
+    """ 已安装的模型列表（ollama.ListResponse.models） """
+    return inventory.list(force)
+
+
+def find_model(models, model_name):
+    for model in models:
+        if model.model == model_name or model.model == f"{model_name}:latest":
+            return model
+    return None
+
+
+def format_progress(event) -> str:
+    """ 把 /api/create 的进度事件格式化为一行日志，下载中的层附带百分比 """
+    total = event.data.get("total")
+    if not total:
+        return event.text
+    percent = int(event.data.get("completed", 0) * 100 / total)
+    return f"{event.text} {percent}%"
+
+
+def create_model(model_name, from_model, parameters=None, template=None, system=None,
+                 on_progress=None):
+    """
+        流式调用 /api/create 构建模型，每条进度通过 on_progress(text) 回调。
+        出错时抛出 RuntimeError。
+    """
+    data = {"model": model_name,
+            "from": from_model,
+            "stream": True}
+    if parameters:
+        data["parameters"] = parameters
+    if template:
+        data["template"] = template
+    if system:
+        data["system"] = system
+
+    try:
+        return stream_progress("create", data, on_progress)
+    finally:
+        inventory.invalidate()  # 无论成功与否，模型列表都可能变化
+
+
+def stream_progress(path, data, on_progress=None):
+    """ 解析 create 等接口的进度流，收到 success 返回 True，出错抛出 RuntimeError """
+    last_text = None
+    last_step = {}
+    with client.post(path, json=data, stream=True) as response:
+        response.raise_for_status()
+        for event in chat.iter_stream_events(response):
+            if event.type == chat.EVENT_ERROR:
+                raise RuntimeError(event.text)
+            if event.type != chat.EVENT_PROGRESS:
+                continue
+            total = event.data.get("total")
+            if total:
+                # 同一层的下载进度很多，只在跨过 PROGRESS_STEP 时输出
+                step = int(event.data.get("completed", 0) * 100 / total) // PROGRESS_STEP
+                if last_step.get(event.text) == step:
+                    continue
+                last_step[event.text] = step
+            text = format_progress(event)
+            if text == last_text:
+                continue
+            last_text = text
+            if on_progress:
+                on_progress(text)
+            if event.text == "success":
+                return True
+    raise RuntimeError(f"{path} {data['model']} ended without success")
+
+
+inventory = ModelInventory()
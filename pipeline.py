@@ -0,0 +1,256 @@
+import abc
+import os
+import threading
+import queue
+import time
+import weakref
+
+
+class CancelToken:
+    """
+        每轮对话一个令牌。用户打断（barge-in）时调用 cancel()，
+        各环节通过 cancelled 检查或注册回调来尽快停止：关闭 LLM 流、丢弃待合成的文本、清空播放。
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Error in cancel callback: {e}")
+
+    def add_callback(self, callback):
+        """ 注册取消回调；如果已经取消，立即执行 """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def wait(self, timeout=None) -> bool:
+        return self._event.wait(timeout)
+
+
+class ReorderBuffer:
+    """
+        并发处理的结果按提交时的序号重新排好再交给 output。
+        每个序号必须 put 一次；结果为 None 表示这一项没有输出（失败或被取消），直接跳过。
+        每一项可以带上所属一轮的 CancelToken，轮到它输出时已取消则丢弃；output(item, token)。
+    """
+
+    def __init__(self, output):
+        self.output = output
+        self.next_seq = 0
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def put(self, seq, item, token=None):
+        with self.lock:
+            self.pending[seq] = (item, token)
+            # 在锁内按序输出，保证多个线程同时完成时顺序不乱
+            while self.next_seq in self.pending:
+                ready, ready_token = self.pending.pop(self.next_seq)
+                self.next_seq += 1
+                if ready is None or (ready_token is not None and ready_token.cancelled):
+                    continue
+                self.output(ready, ready_token)
+
+
+POLICY_BLOCK = "block"  # 队列满时阻塞生产者
+POLICY_MERGE = "merge"  # 队列满时尽量合并到最后一项，不能合并时阻塞
+POLICY_SPILL = "spill"  # 队列满时把新的一项写到磁盘，内存中只保留占位对象
+
+CANCEL_CHECK_INTERVAL = 1.0  # 阻塞的 put 检查 cancelled 的最长间隔（秒）
+
+_queues = weakref.WeakSet()  # 所有队列，用于显示实时深度
+
+
+class TimedQueue(queue.Queue):
+    """
+        记录每一项从 put 到被取走的等待时间，即这一环节给每轮对话增加的延迟。
+        消费者用阻塞的 get(timeout=...) 等待，结束时放入 None 作为结束标志。
+    """
+
+    def __init__(self, name, maxsize=0):
+        super().__init__(maxsize)
+        self.name = name
+        self.items = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        _queues.add(self)
+
+    def _put(self, item):
+        self.queue.append((time.perf_counter(), item))
+
+    def _get(self):
+        put_time, item = self.queue.popleft()
+        wait = time.perf_counter() - put_time
+        self.items += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        return item
+
+    def clear(self):
+        with self.mutex:
+            self._clear()
+            self.not_full.notify_all()  # 唤醒被阻塞的生产者
+
+    def _clear(self):
+        for _, item in self.queue:
+            if isinstance(item, Spilled):
+                item.discard()
+        self.queue.clear()
+
+    def gauge(self) -> str:
+        """ 当前深度，maxsize 为 0 表示不限 """
+        depth = self.qsize()
+        return f"{self.name} {depth}/{self.maxsize}" if self.maxsize else f"{self.name} {depth}"
+
+    def report(self) -> str:
+        average = self.wait_total / self.items * 1000 if self.items else 0.0
+        return (f"{self.name} queue: {self.items} items, "
+                f"wait avg {average:.1f}ms, max {self.wait_max * 1000:.1f}ms")
+
+
+class Spilled(abc.ABC):
+    """ 写到磁盘上的队列项的占位对象，取出时 load() 读回原来的对象，子类负责读取格式 """
+
+    def __init__(self, path):
+        self.path = path
+
+    @abc.abstractmethod
+    def load(self):
+        """ 读回原来的对象并删除文件 """
+
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class BoundedQueue(TimedQueue):
+    """
+        有上限的队列，满了之后按 policy 处理：阻塞生产者、合并到最后一项（merge(last, item)，
+        返回 None 表示不能合并）或写到磁盘（spill(item) 返回 Spilled，返回 None 表示不能写出）。
+        不能合并或写出时退回到阻塞，内存中的项数始终不超过 maxsize。
+    """
+
+    def __init__(self, name, maxsize, policy=POLICY_BLOCK, merge=None, spill=None):
+        super().__init__(name, maxsize)
+        self.policy = policy
+        self.merge = merge
+        self.spill = spill
+        self.max_depth = 0
+        self.blocked = 0
+        self.merged = 0
+        self.spilled = 0
+        self.in_memory = 0  # 不含已写到磁盘的项
+
+    def put(self, item, block=True, timeout=None, cancelled=None):
+        """
+            cancelled 为可选的回调，返回 True 时放弃这一项并返回 False：
+            进入时和每次被唤醒后都会检查，clear() 唤醒的生产者不会把过期的项放进刚清空的队列。
+        """
+        with self.not_full:
+            if cancelled is not None and cancelled():
+                return False
+            if self.maxsize > 0 and self.in_memory >= self.maxsize:
+                if self.policy == POLICY_MERGE and self.merge is not None and self.queue:
+                    put_time, last = self.queue[-1]
+                    merged = self.merge(last, item)
+                    if merged is not None:
+                        self.queue[-1] = (put_time, merged)
+                        self.merged += 1
+                        return True
+                elif self.policy == POLICY_SPILL and self.spill is not None:
+                    spilled = self.spill(item)
+                    if spilled is not None:
+                        # 写到磁盘的项不占内存名额，直接放入
+                        self.queue.append((time.perf_counter(), spilled))
+                        self.max_depth = max(self.max_depth, len(self.queue))
+                        self.spilled += 1
+                        self.unfinished_tasks += 1
+                        self.not_empty.notify()
+                        return True
+                # 不能合并或写出：阻塞生产者，直到消费者取走内存中的项
+                self.blocked += 1
+                if not block:
+                    raise queue.Full
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while self.in_memory >= self.maxsize:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise queue.Full
+                    if cancelled is not None:
+                        # 取消一般伴随 clear() 的唤醒，这里只是兜底
+                        remaining = CANCEL_CHECK_INTERVAL if remaining is None else min(
+                            remaining, CANCEL_CHECK_INTERVAL)
+                    self.not_full.wait(remaining)
+                    if cancelled is not None and cancelled():
+                        return False
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+            return True
+
+    def _put(self, item):
+        super()._put(item)
+        self.in_memory += 1
+        self.max_depth = max(self.max_depth, len(self.queue))
+
+    def _get(self):
+        item = super()._get()
+        if isinstance(item, Spilled):
+            return item.load()
+        self.in_memory -= 1
+        return item
+
+    def _clear(self):
+        super()._clear()
+        self.in_memory = 0
+
+    def report(self) -> str:
+        return (f"{super().report()}, depth max {self.max_depth}/{self.maxsize} ({self.policy}), "
+                f"blocked {self.blocked}, merged {self.merged}, spilled {self.spilled}")
+
+
+def queue_gauges() -> str:
+    """ 所有队列的当前深度 """
+    return " | ".join(q.gauge() for q in sorted(_queues, key=lambda q: q.name))
+
+
+class CpuMeter:
+    """ 统计一段时间内进程的 CPU 占用，用于确认空闲时各线程没有空转 """
+
+    def __init__(self):
+        self.start()
+
+    def start(self):
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+
+    def report(self) -> str:
+        wall = time.perf_counter() - self.wall_start
+        cpu = time.process_time() - self.cpu_start
+        percent = cpu / wall * 100 if wall > 0 else 0.0
+        return f"CPU {percent:.1f}% over {wall:.1f}s"
@@ -0,0 +1,160 @@
+import threading
+import time
+import client
+import models
+
+MODE_PIN = "pin"          # 两个模型都常驻显存
+MODE_OFFLOAD = "offload"  # 显存放不下：embedding 模型放到 CPU 上运行，不再挤出对话模型
+
+VRAM_HEADROOM = 0.9     # 只按显存预算的 90% 规划，给 KV cache 等留余量
+VRAM_OVERHEAD = 1.2     # 未加载的模型按文件大小的 1.2 倍估算显存占用
+SWAP_LOAD_MS = 200      # 已加载过的模型再次出现超过这个加载耗时，视为被换出后重新加载
+PLAN_INTERVAL = 30      # 两次检查 /api/ps 的最小间隔（秒）
+PIN_RETRY_INTERVAL = 600  # 没有显存预算时，offload 持续这么久后重新尝试常驻（秒）
+
+
+class ResidencyPlanner:
+    """
+        对话模型和 embedding 模型共用一张显卡时的驻留规划。
+        通过 /api/ps 查看已加载的模型并估算显存：放得下就让两者常驻，
+        放不下就把 embedding 计算放到 CPU（num_gpu=0），避免每轮消息互相换出。
+        同时根据每次请求返回的 load_duration 统计换出次数和额外耗时：
+        只有两次请求之间运行过另一个模型才算换出，keep_alive 到期或 Ollama 重启后的重新加载不算。
+    """
+
+    def __init__(self, vram_budget=None):
+        self.vram_budget = vram_budget  # 字节，None 表示根据运行情况推断
+        self.chat_model = None
+        self.embedding_model = None
+        self.mode = MODE_PIN
+        self.sizes = {}
+        self.loaded = set()  # 加载过的模型
+        self.last_model = None  # 最近一次请求的模型
+        self.offload_since = 0.0
+        self.swap_count = 0
+        self.swap_ms = 0.0
+        self.last_plan = 0.0
+        self.lock = threading.Lock()
+
+    def set_models(self, chat_model=None, embedding_model=None):
+        with self.lock:
+            if chat_model:
+                self.chat_model = chat_model
+            if embedding_model:
+                self.embedding_model = embedding_model
+            self.last_plan = 0.0
+            self.offload_since = 0.0  # 换了模型，下次规划时重新尝试常驻
+
+    def running_models(self) -> dict:
+        """ /api/ps：模型名 -> 显存占用（字节） """
+        response = client.get("ps")
+        response.raise_for_status()
+        return {model["name"]: model.get("size_vram", model.get("size", 0))
+                for model in response.json().get("models", [])}
+
+    def installed_sizes(self) -> dict:
+        """ 模型名 -> 文件大小（字节），来自 models.inventory 的缓存 """
+        return models.inventory.sizes()
+
+    def estimate_vram(self, model, running: dict, installed: dict) -> int:
+        size = self.lookup(model, running)
+        if size:
+            return size
+        return int(self.lookup(model, installed) * VRAM_OVERHEAD)
+
+    @staticmethod
+    def lookup(model, sizes: dict) -> int:
+        if model in sizes:
+            return sizes[model]
+        return sizes.get(f"{model}:latest", 0)
+
+    def plan(self, force=False) -> str:
+        """ 根据已加载模型和显存估算决定驻留方式，结果会缓存 PLAN_INTERVAL 秒 """
+        if not self.chat_model or not self.embedding_model:
+            return self.mode
+        if not force and time.time() - self.last_plan < PLAN_INTERVAL:
+            return self.mode
+        try:
+            running = self.running_models()
+            installed = self.installed_sizes() if self.vram_budget else {}
+        except Exception as e:
+            print(f"Error checking loaded models: {e}")
+            return self.mode
+
+        with self.lock:
+            self.last_plan = time.time()
+            chat_running = self.lookup(self.chat_model, running) > 0
+            embedding_running = self.lookup(self.embedding_model, running) > 0
+            if chat_running and embedding_running:
+                mode = MODE_PIN  # 已经同时在显存里
+            elif self.vram_budget:
+                self.sizes = {model: self.estimate_vram(model, running, installed)
+                              for model in (self.chat_model, self.embedding_model)}
+                total = sum(self.sizes.values())
+                mode = MODE_PIN if total <= self.vram_budget * VRAM_HEADROOM else MODE_OFFLOAD
+            elif self.mode == MODE_OFFLOAD and time.time() - self.offload_since >= PIN_RETRY_INTERVAL:
+                # offload 时 embedding 不占显存，/api/ps 看不出能否同时常驻：隔一段时间再试一次，
+                # 仍然换出的话 record_load 会再切回 offload
+                mode = MODE_PIN
+            else:
+                mode = self.mode  # 无法判断时沿用当前方式，由 record_load 根据换出情况调整
+            self.set_mode(mode)
+            return self.mode
+
+    def set_mode(self, mode):
+        if mode == self.mode:
+            return
+        print(f"Model residency: {self.mode} -> {mode}")
+        self.mode = mode
+        if mode == MODE_OFFLOAD:
+            self.offload_since = time.time()
+        # embedding 模型换到 CPU 会加载一次，不计入换出
+        self.loaded.discard(self.embedding_model)
+
+    def embedding_options(self):
+        """ 附加到 embedding 请求的 options """
+        if self.mode == MODE_OFFLOAD:
+            return {"num_gpu": 0}
+        return None
+
+    def mark_loaded(self, model):
+        """ 预加载后调用：只加载的请求没有 load_duration，之后的请求才能判断是否被换出 """
+        with self.lock:
+            self.loaded.add(model)
+            self.last_model = model
+
+    def record_load(self, model, load_ms: float):
+        """ 每次请求后调用，load_ms 为 Ollama 返回的 load_duration（毫秒） """
+        with self.lock:
+            swapped = (model in self.loaded and load_ms > SWAP_LOAD_MS
+                       and self.last_model is not None and self.last_model != model)
+            self.loaded.add(model)
+            self.last_model = model
+            if not swapped:
+                return
+            self.swap_count += 1
+            self.swap_ms += load_ms
+            print(
+                f"Model {model} was reloaded ({load_ms:.0f}ms), swaps: {self.swap_count}")
+            check = model in (self.chat_model, self.embedding_model) and self.mode == MODE_PIN
+        if check:
+            self.confirm_swap()
+
+    def confirm_swap(self):
+        """ 确认两个模型确实不能同时在显存中后，之后 embedding 在 CPU 上运行 """
+        try:
+            running = self.running_models()
+        except Exception as e:
+            print(f"Error checking loaded models: {e}")
+            return
+        with self.lock:
+            if self.lookup(self.chat_model, running) > 0 and self.lookup(self.embedding_model, running) > 0:
+                return  # 又都加载上了，可能只是显存暂时不够
+            self.last_plan = time.time()
+            self.set_mode(MODE_OFFLOAD)
+
+    def report(self) -> str:
+        return f"Model residency: {self.mode}, swaps: {self.swap_count}, added latency: {self.swap_ms:.0f}ms"
+
+
+planner = ResidencyPlanner()
@@ -8,6 +8,8 @@ import webrtcvad
 import time
 from pydub import AudioSegment
 import wave
+import tempfile
+from pipeline import BoundedQueue, Spilled, POLICY_SPILL
 
 # 麦克风参数
 FORMAT = pyaudio.paInt16
@@ -20,11 +22,34 @@ SPEECH_END = "<end>"  # 说话结束的特殊字符
 SILENCE_THRESHOLD_MS = 1000  # 说话结束的静音阈值（毫秒）
 
 AUDIO_SAVE_DIR = "recordings"  # Directory to save recordings
+QUEUE_TIMEOUT = 1.0  # 阻塞等待的最长时间，正常由结束标志 None 唤醒
+AUDIO_QUEUE_SIZE = 4  # 等待识别的语音段上限，识别跟不上时之后的语音段写到临时文件，录音线程不阻塞
+
+
+class SpilledSpeech(Spilled):
+    """ 写到临时文件的一段语音（int16 PCM 字节） """
+
+    def load(self) -> bytes:
+        with open(self.path, "rb") as f:
+            data = f.read()
+        self.discard()
+        return data
+
+
+def spill_speech(item):
+    """ 只写出语音数据，说话开始标志很小，不写出 """
+    if not isinstance(item, bytes):
+        return None
+    fd, path = tempfile.mkstemp(suffix=".pcm")
+    with os.fdopen(fd, "wb") as f:
+        f.write(item)
+    return SpilledSpeech(path)
 
 
 class Faster_Whisper_STT:
     def __init__(self, text_queue, model_path="./model/faster-whisper-small"):
-        self.audio_queue = queue.Queue()
+        self.audio_queue = BoundedQueue(
+            "STT audio", AUDIO_QUEUE_SIZE, POLICY_SPILL, spill=spill_speech)
         self.text_queue = text_queue  # 用于将识别结果传递到主线程
         self.stop_event = threading.Event()
         self.is_recording = False
@@ -77,12 +102,17 @@ class Faster_Whisper_STT:
             return
         self.is_recording = False
         self.stop_event.set()
+        try:
+            self.audio_queue.put_nowait(None)  # 唤醒识别线程
+        except queue.Full:
+            pass  # 队列满说明识别线程没在等待，会在 QUEUE_TIMEOUT 内看到 stop_event
         # print("停止语音识别...")
         self.recording_thread.join()
         self.recognizing_thread.join()
         # print("语音识别线程已结束。")
         self.recording_thread = None
         self.recognizing_thread = None
+        self.audio_queue.clear()
 
     def is_speech(self, data):
         frame_size = int(SAMPLE_RATE * 0.02 * 1)  # 10ms* 1的帧大小,调高高噪环境识别率
@@ -112,7 +142,10 @@ class Faster_Whisper_STT:
             data = stream.read(CHUNK)
             if self.is_speech(data):
                 if not speech_detected:
-                    self.audio_queue.put(SPEECH_START)  # 检测到说话开始
+                    try:
+                        self.audio_queue.put_nowait(SPEECH_START)  # 检测到说话开始
+                    except queue.Full:
+                        pass  # 识别积压时不阻塞录音（会丢麦克风数据），只是这次不能打断
                     speech_detected = True
                 speech_buffer.extend(data)
                 silence_count = 0
@@ -132,20 +165,23 @@ class Faster_Whisper_STT:
 
     def recognize_audio(self):
         while not self.stop_event.is_set():
-            if not self.audio_queue.empty():
-                item = self.audio_queue.get()
-                if item == SPEECH_START:
-                    self.text_queue.put(SPEECH_START)  # 将说话开始标志放入 text_queue
-                else:
-                    audio_data = np.frombuffer(item, dtype=np.int16)
-                    segments, info = self.model.transcribe(audio_data.astype(
-                        np.float16) / np.iinfo(np.int16).max, beam_size=5)
-                    recognized_text = " ".join(segment.text.strip()
-                                               for segment in segments)
-                    print(f"[{info.language}] {recognized_text}")
-                    self.text_queue.put(recognized_text)  # 将识别结果放入 text_queue
-                    self.text_queue.put(SPEECH_END)  # 将说话结束标志放入 text_queue
-            time.sleep(0.1)
+            try:
+                item = self.audio_queue.get(timeout=QUEUE_TIMEOUT)
+            except queue.Empty:
+                continue
+            if item is None:
+                break
+            if item == SPEECH_START:
+                self.text_queue.put(SPEECH_START)  # 将说话开始标志放入 text_queue
+            else:
+                audio_data = np.frombuffer(item, dtype=np.int16)
+                segments, info = self.model.transcribe(audio_data.astype(
+                    np.float16) / np.iinfo(np.int16).max, beam_size=5)
+                recognized_text = " ".join(segment.text.strip()
+                                           for segment in segments)
+                print(f"[{info.language}] {recognized_text}")
+                self.text_queue.put(recognized_text)  # 将识别结果放入 text_queue
+                self.text_queue.put(SPEECH_END)  # 将说话结束标志放入 text_queue
 
 
 def load_audio_file(file_path):
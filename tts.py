@@ -1,19 +1,130 @@
+import os
 import requests
 import threading
 import time
 import queue
+import math
+import wave
+import struct
+import numpy as np
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from vox import PCMStream, PCMClip
+from pipeline import ReorderBuffer, BoundedQueue, POLICY_MERGE
+import cache
 
 gpt_sovits_tts_url = "http://127.0.0.1:9880/tts"
+gpt_sovits_refer_audio_url = "http://127.0.0.1:9880/set_refer_audio"
+CHUNK_SIZE = 8192
+STREAM_CHUNK_SIZE = 4096  # 流式模式每次读取的字节数，越小首个音频块越早交给播放器
+MAX_WAV_HEADER_SIZE = 4096
+TTS_WORKERS = 3         # 同时发出的合成请求上限
+RTF_SMOOTHING = 0.3     # 实时率（合成耗时 / 音频时长）的指数平均系数
+TTS_BACKEND_VERSION = "gpt-sovits-api_v2"  # 更换 TTS 后端或模型时修改，使旧的缓存失效
+WARM_UP_CHARS = 8       # 预热合成使用参考文本的前几个字
+REFER_AUDIO_TIMEOUT = 60
+QUEUE_TIMEOUT = 1.0     # 阻塞等待的最长时间，只用于兜底检查 stop_event，正常由结束标志唤醒
+TEXT_QUEUE_SIZE = 64    # 待合成句子的上限
+MAX_MERGED_CHARS = 200  # 队列满时合并相邻句子，合并后的长度上限
+
+
+def merge_text(last, item):
+    """ 同一轮对话的两句合并为一句，超过长度上限或是结束标志时返回 None """
+    if last is None or item is None:
+        return None
+    (last_text, last_token), (text, token) = last, item
+    if last_token is not token or len(last_text) + len(text) > MAX_MERGED_CHARS:
+        return None
+    # 中日韩文字之间直接连接，有一侧是西文时加空格，避免 "Hello.How"
+    cjk = last_text[-1:] >= "\u2e80" and text[:1] >= "\u2e80"
+    separator = "" if cjk or last_text[-1:].isspace() or text[:1].isspace() else " "
+    return last_text + separator + text, token
+
+
+def parse_wav_header(data: bytes):
+    """
+        解析 WAV 头，返回 (头长度, 采样率, 声道数, 采样字节数)，数据不够时返回 None。
+        流式模式下头里的长度字段没有意义，只取格式信息。
+    """
+    if len(data) < 12:
+        return None
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        raise ValueError("Not a WAV stream")
+    offset = 12
+    fmt = None
+    while len(data) >= offset + 8:
+        chunk_id, chunk_size = struct.unpack("<4sI", data[offset:offset + 8])
+        if chunk_id == b"data":
+            if fmt is None:
+                raise ValueError("WAV stream has no fmt chunk")
+            return (offset + 8,) + fmt
+        if len(data) < offset + 8 + chunk_size:
+            return None
+        if chunk_id == b"fmt ":
+            channels, sample_rate = struct.unpack(
+                "<HI", data[offset + 10:offset + 16])
+            bits = struct.unpack("<H", data[offset + 22:offset + 24])[0]
+            fmt = (sample_rate, channels, bits // 8)
+        offset += 8 + chunk_size + (chunk_size & 1)
+    return None
+
+
+def wav_to_clip(data: bytes) -> PCMClip:
+    """ 解析 WAV 头后直接引用其中的 int16 数据（不复制、不经过 pydub 解码） """
+    header = parse_wav_header(data[:MAX_WAV_HEADER_SIZE])
+    if header is None:
+        raise ValueError("Incomplete WAV data")
+    header_size, sample_rate, channels, sample_width = header
+    if sample_width != 2:
+        raise ValueError(f"Unsupported sample width: {sample_width}")
+    count = (len(data) - header_size) // sample_width
+    samples = np.frombuffer(data, dtype=np.int16,
+                            count=count, offset=header_size)
+    return PCMClip(samples, sample_rate, channels)
+
+
+def pcm_to_wav(data: bytes, sample_rate, channels, sample_width) -> bytes:
+    buffer = BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(channels)
+        wav_file.setsampwidth(sample_width)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(data)
+    return buffer.getvalue()
+
+
+def audio_duration_ms(num_bytes, sample_rate, frame_width) -> float:
+    if not sample_rate or not frame_width:
+        return 0.0
+    return num_bytes / frame_width / sample_rate * 1000
 
 
 class GPT_Sovits_TTS:
-    def __init__(self, character, audio_queue: queue.Queue):
+    def __init__(self, character, audio_queue: queue.Queue, cache_bytes=cache.DEFAULT_AUDIO_CACHE_BYTES,
+                 queue_size=TEXT_QUEUE_SIZE, queue_policy=POLICY_MERGE):
         self.character = character
         self.audio_queue = audio_queue
-        self.text_queue = queue.Queue()
+        # 模型输出比合成快时，满了先合并相邻句子，再不行就让生成线程等待
+        self.text_queue = BoundedQueue(
+            "TTS text", queue_size, queue_policy, merge=merge_text)
         self.stop_event = threading.Event()
         self.tts_thread = None
+        # 每种模式的耗时统计：句数、首个音频可播放的总耗时、整句下载完的总耗时（毫秒）
+        self.latency = {"stream": [0, 0.0, 0.0], "wav": [0, 0.0, 0.0]}
+        # 流水线：提前发出后面几句的请求，结果按序号重排后再播放
+        self.executor = ThreadPoolExecutor(
+            max_workers=TTS_WORKERS, thread_name_prefix="tts")
+        self.reorder = ReorderBuffer(self.put_audio)
+        self.next_seq = 0
+        self.in_flight = 0
+        self.in_flight_changed = threading.Condition()
+        self.lookahead = 1  # 根据实时率调整，合成比播放慢时多发几句
+        self.rtf = None
+        # 合成结果的磁盘缓存，保存在当前角色目录下，cache_bytes 为 0 时不使用
+        self.cache_bytes = cache_bytes
+        self.audio_cache = None
+        self.registered_ref = None  # 已在服务端设置的参考音频
+        self.prepare_lock = threading.Lock()
 
     def start(self):
         self.stop_event.clear()
@@ -26,16 +137,22 @@ class GPT_Sovits_TTS:
 
     def stop(self):
         self.stop_event.set()
+        try:
+            self.text_queue.put_nowait(None)  # 唤醒等待中的 tts_process
+        except queue.Full:
+            pass  # 队列满说明 tts_process 没在等待，会在 QUEUE_TIMEOUT 内看到 stop_event
+        with self.in_flight_changed:
+            self.in_flight_changed.notify_all()
         self.tts_thread.join()
         self.clear_text_queue()
         self.tts_thread = None
         # print("TTS进程已停止。")
 
     def clear_text_queue(self):
-        self.text_queue.queue.clear()
+        self.text_queue.clear()
         # print("文本队列已清空。")
 
-    def add_text_to_queue(self, text):
+    def add_text_to_queue(self, text, token=None):
         if self.stop_event.is_set():
             # print("TTS服务未启动，无法添加文本。")
             return
@@ -45,11 +162,59 @@ class GPT_Sovits_TTS:
         # if len(text) > 1024:
         #     print("文本过长，无法添加。")
         #     return
-        self.text_queue.put(text)
+        if token is not None and token.cancelled:
+            return
+        # 队列满时阻塞，打断（clear_text_queue 唤醒）或停止后放弃
+        self.text_queue.put((text, token), cancelled=lambda: self.stop_event.is_set() or (
+            token is not None and token.cancelled))
         # print(f"已将文本添加到队列：{text}")
 
-    def get_audio_from_api(self, text):
-        params = {
+    def prepare_character(self):
+        """ 角色加载或参考音频变化时调用：后台设置参考音频并预热一次合成 """
+        threading.Thread(target=self.prepare_process, daemon=True).start()
+
+    def prepare_process(self):
+        with self.prepare_lock:  # 连续切换时按顺序执行，已设置的参考音频不再重复处理
+            ref_audio_path = self.character.get("ref_audio_path")
+            if not ref_audio_path or ref_audio_path == self.registered_ref:
+                return
+            try:
+                start = time.perf_counter()
+                # 旧版本服务没有 /set_refer_audio 时，预热合成同样会让服务端缓存参考音频
+                registered = self.register_reference(ref_audio_path)
+                if self.warm_up() or registered:
+                    self.registered_ref = ref_audio_path
+                    print(
+                        f"TTS reference ready in {(time.perf_counter() - start) * 1000:.0f}ms: {ref_audio_path}")
+            except Exception as e:
+                print(f"Error preparing TTS reference audio: {e}")
+
+    def register_reference(self, ref_audio_path) -> bool:
+        """
+            api_v2 的 /set_refer_audio：服务端提前处理参考音频。
+            /tts 仍要求 ref_audio_path，但路径相同时服务端直接使用缓存的结果，之后每句不再重复处理。
+        """
+        response = requests.get(gpt_sovits_refer_audio_url,
+                                params={"refer_audio_path": ref_audio_path},
+                                timeout=REFER_AUDIO_TIMEOUT)
+        if response.status_code != 200:
+            print(
+                f"Failed to set reference audio. Status code: {response.status_code}")
+            return False
+        return True
+
+    def warm_up(self) -> bool:
+        """ 合成一小段参考文本并丢弃结果，让第一句话不必承担模型的首次推理开销 """
+        text = (self.character.get("prompt_text") or "")[:WARM_UP_CHARS]
+        if not text:
+            return False
+        response = requests.get(gpt_sovits_tts_url, params=self.get_params(text),
+                                timeout=REFER_AUDIO_TIMEOUT)
+        response.close()
+        return response.status_code == 200
+
+    def get_params(self, text, streaming_mode=False):
+        return {
             "text": text,
             "text_lang": "auto",
             "ref_audio_path": self.character["ref_audio_path"],
@@ -58,30 +223,248 @@ class GPT_Sovits_TTS:
             "speed_factor": self.character["speed_factor"],
             "text_split_method": "cut5",
             "media_type": "wav",
-            "parallel_infer": True,
-            "streaming_mode": False
+            "parallel_infer": not streaming_mode,
+            "streaming_mode": streaming_mode
         }
+
+    def get_audio_cache(self):
+        folder = self.character.get("folder")
+        if not self.cache_bytes or not folder:
+            return None
+        if self.audio_cache is None or self.audio_cache.folder != os.path.join(folder, cache.AUDIO_CACHE_FOLDER):
+            self.audio_cache = cache.AudioCache(folder, self.cache_bytes)
+        return self.audio_cache
+
+    def get_cache_key(self, text):
+        """ 按影响合成结果的参数计算缓存 key，参考音频按内容计算摘要 """
+        ref_digest = cache.file_digest(self.character["ref_audio_path"])
+        if ref_digest is None:
+            return None
+        params = self.get_params(text)
+        for name in ("streaming_mode", "parallel_infer"):
+            params.pop(name)
+        params["ref_audio_path"] = ref_digest
+        params["backend"] = TTS_BACKEND_VERSION
+        return cache.AudioCache.make_key(params)
+
+    def get_audio(self, text, token=None, output=None):
+        output = output or self.audio_queue.put
+        if token is not None and token.cancelled:
+            return
+        audio_cache = self.get_audio_cache()
+        cache_key = self.get_cache_key(text) if audio_cache is not None else None
+        if cache_key is not None:
+            data = audio_cache.get(cache_key)
+            if data is not None:
+                try:
+                    output(wav_to_clip(data))  # 命中时不请求 GPT-SoVITS
+                    return
+                except ValueError as e:
+                    print(f"Invalid cached audio: {e}")
+                    audio_cache.remove(cache_key)
+        # 角色卡中 tts_streaming 为 true 时边合成边播放
+        if self.character.get("streaming_mode"):
+            data = self.get_streaming_audio_from_api(text, token, output)
+        else:
+            data = self.get_audio_from_api(text, token, output)
+        if data and cache_key is not None and (token is None or not token.cancelled):
+            audio_cache.put(cache_key, data)
+
+    def get_audio_from_api(self, text, token=None, output=None):
+        """ 下载整句 WAV，解析为 PCMClip 后交给 output（默认直接放入播放队列），返回 WAV 数据 """
+        output = output or self.audio_queue.put
+        params = self.get_params(text)
+        response = None
+        start = time.perf_counter()
         try:
             response = requests.get(
-                gpt_sovits_tts_url, params=params, stream=False)
+                gpt_sovits_tts_url, params=params, stream=True)
+            if token is not None:
+                # 打断时直接关闭连接，不再等待这一句下载完
+                token.add_callback(response.close)
             if response.status_code == 200:
-                # 将响应内容转换为 BytesIO 对象
-                audio_data = BytesIO(response.content)
-                self.audio_queue.put(audio_data)
+                chunks = []
+                for data in response.iter_content(chunk_size=CHUNK_SIZE):
+                    if token is not None and token.cancelled:
+                        return
+                    chunks.append(data)
+                if token is None or not token.cancelled:
+                    data = b"".join(chunks)
+                    clip = wav_to_clip(data)
+                    output(clip)
+                    elapsed_ms = (time.perf_counter() - start) * 1000
+                    self.record_latency("wav", elapsed_ms, elapsed_ms, clip.duration_ms)
+                    return data
             else:
                 print(
                     f"Failed to get audio data. Status code: {response.status_code}")
-        except requests.exceptions.RequestException as e:
+        except Exception as e:
             # print(f"生成音频失败，TTS 引擎未启动？错误信息:\n {e}")
             pass
+        finally:
+            if response is not None:
+                if token is not None:
+                    token.remove_callback(response.close)
+                response.close()
+
+    def get_streaming_audio_from_api(self, text, token=None, output=None):
+        """
+            streaming_mode：收到第一段 PCM 就把 PCMStream 交给 output，之后的数据边收边写。
+            完整收到后返回整句的 WAV 数据（用于缓存）。
+        """
+        output = output or self.audio_queue.put
+        params = self.get_params(text, streaming_mode=True)
+        response = None
+        pcm_stream = None
+        start = time.perf_counter()
+        first_ms = None
+        audio_bytes = 0
+        chunks = []
+        try:
+            response = requests.get(
+                gpt_sovits_tts_url, params=params, stream=True)
+            if token is not None:
+                token.add_callback(response.close)
+            if response.status_code != 200:
+                print(
+                    f"Failed to get audio data. Status code: {response.status_code}")
+                return
+            pending = b""
+            for data in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                if token is not None and token.cancelled:
+                    return
+                pending += data
+                if pcm_stream is None:
+                    header = parse_wav_header(pending)
+                    if header is None:
+                        if len(pending) > MAX_WAV_HEADER_SIZE:
+                            raise ValueError("WAV header too large")
+                        continue
+                    header_size, sample_rate, channels, sample_width = header
+                    if sample_width != 2:  # 播放器按 int16 读取，与 wav_to_clip 一致
+                        raise ValueError(f"Unsupported sample width: {sample_width}")
+                    pcm_stream = PCMStream(sample_rate, channels, sample_width)
+                    pending = pending[header_size:]
+                # 按整帧写出，剩下的半帧留到下一块
+                size = len(pending) - len(pending) % pcm_stream.frame_width
+                if size <= 0:
+                    continue
+                pcm_stream.write(pending[:size])
+                chunks.append(pending[:size])
+                pending = pending[size:]
+                audio_bytes += size
+                if first_ms is None:
+                    first_ms = (time.perf_counter() - start) * 1000
+                    output(pcm_stream)
+            if first_ms is not None:
+                self.record_latency(
+                    "stream", first_ms, (time.perf_counter() - start) * 1000,
+                    audio_duration_ms(audio_bytes, pcm_stream.sample_rate, pcm_stream.frame_width))
+                return pcm_to_wav(b"".join(chunks), pcm_stream.sample_rate,
+                                  pcm_stream.channels, pcm_stream.sample_width)
+        except Exception as e:
+            if token is None or not token.cancelled:
+                print(f"Error streaming audio: {e}")
+        finally:
+            if pcm_stream is not None:
+                pcm_stream.close()
+            if response is not None:
+                if token is not None:
+                    token.remove_callback(response.close)
+                response.close()
+
+    def record_latency(self, mode, first_ms, total_ms, audio_ms=0.0):
+        stats = self.latency[mode]
+        stats[0] += 1
+        stats[1] += first_ms
+        stats[2] += total_ms
+        if audio_ms > 0:
+            self.update_lookahead(total_ms / audio_ms)
+
+    def update_lookahead(self, rtf):
+        """
+            合成一句平均要 rtf 句的播放时间，同时进行 ceil(rtf) 个请求才跟得上播放，
+            再多留一个余量；合成比播放快很多时只提前一句。
+        """
+        with self.in_flight_changed:
+            self.rtf = rtf if self.rtf is None else (
+                RTF_SMOOTHING * rtf + (1 - RTF_SMOOTHING) * self.rtf)
+            lookahead = min(TTS_WORKERS, max(1, math.ceil(self.rtf) + 1))
+            if lookahead != self.lookahead:
+                print(f"TTS look-ahead: {self.lookahead} -> {lookahead} (rtf {self.rtf:.2f})")
+                self.lookahead = lookahead
+                self.in_flight_changed.notify_all()
+
+    def report(self) -> str:
+        """ 两种模式的平均首个音频耗时和整句耗时，用于比较 """
+        parts = []
+        for mode, (count, first_ms, total_ms) in self.latency.items():
+            if count:
+                parts.append(
+                    f"{mode}: {count} sentences, first audio {first_ms / count:.0f}ms, total {total_ms / count:.0f}ms")
+        if self.rtf is not None:
+            parts.append(f"rtf {self.rtf:.2f}, look-ahead {self.lookahead}")
+        report = "TTS latency: " + ("; ".join(parts) if parts else "no data")
+        report += f"\n{self.text_queue.report()}"
+        if self.audio_cache is not None:
+            report += f"\n{self.audio_cache.report()}"
+        return report
+
+    def synthesize(self, seq, text, token):
+        """ 在线程池中合成一句，结果按 seq 交给重排缓冲区；没有结果时也要占位，后面的句子才能播放 """
+        delivered = False
+
+        def output(item):
+            nonlocal delivered
+            delivered = True
+            self.reorder.put(seq, item, token)
+
+        try:
+            self.get_audio(text, token, output)
+        finally:
+            if not delivered:
+                self.reorder.put(seq, None)
+            with self.in_flight_changed:
+                self.in_flight -= 1
+                self.in_flight_changed.notify_all()
+
+    def put_audio(self, item, token=None):
+        """
+            音频队列满时等待播放线程取走。这一轮被打断或 TTS 停止后放弃，
+            打断时 flush() 清空队列唤醒的等待也不会把旧的音频放回队列
+        """
+        self.audio_queue.put(item, cancelled=lambda: self.stop_event.is_set() or (
+            token is not None and token.cancelled))
+
+    def wait_for_slot(self) -> bool:
+        """ 等到进行中的请求少于 look-ahead，停止时返回 False """
+        with self.in_flight_changed:
+            while self.in_flight >= self.lookahead:
+                if self.stop_event.is_set():
+                    return False
+                self.in_flight_changed.wait(timeout=QUEUE_TIMEOUT)
+            self.in_flight += 1
+            return True
 
     def tts_process(self):
         while not self.stop_event.is_set():
-            if not self.text_queue.empty():
-                text = self.text_queue.get()
-                if text:
-                    self.get_audio_from_api(text)
-                elif text is None:  # Check for None explicitly
+            try:
+                item = self.text_queue.get(timeout=QUEUE_TIMEOUT)
+            except queue.Empty:
+                continue
+            if item is None:  # Check for None explicitly
+                break
+            text, token = item
+            if token is not None and token.cancelled:
+                continue  # 这一轮已被打断，丢弃
+            if text:
+                if not self.wait_for_slot():
                     break
-            time.sleep(0.01)  # Reduce sleep time for responsiveness
+                if token is not None and token.cancelled:
+                    with self.in_flight_changed:
+                        self.in_flight -= 1
+                    continue
+                seq = self.next_seq
+                self.next_seq += 1
+                self.executor.submit(self.synthesize, seq, text, token)
         # print("TTS 处理线程已停止")
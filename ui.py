@@ -1,22 +1,26 @@
 import os
 import threading
+from concurrent.futures import ThreadPoolExecutor
 import customtkinter as ctk
 from tkinter import filedialog, messagebox
 from stt import Faster_Whisper_STT
-from stt import SPEECH_START
-from stt import SPEECH_END
 from tts import GPT_Sovits_TTS
 from vox import AudioPlayer
+from vox import spill_clip
 import chat as chat
 from PIL import Image
 import queue
 import json
-import re
 import time
 import sys
 import utils
-import ollama as ollama
 import mem as mem
+import client
+import pipeline
+import residency
+import cache
+import models
+from engine import ConversationEngine
 
 
 Font_YaHei_11 = ("Microsoft YaHei", 11)
@@ -25,10 +29,89 @@ Font_YaHei_14 = ("Microsoft YaHei", 14)
 Font_YaHei_18 = ("Microsoft YaHei", 18)
 Font_YaHei_20 = ("Microsoft YaHei", 20)
 
+UI_REFRESH_MS = 33  # 界面刷新间隔，约 30 帧/秒
+RETRIEVAL_WORKERS = 2  # 记忆检索线程数
+MAX_PENDING_RETRIEVALS = 8
+QUEUE_GAUGE_MS = 500  # 队列深度显示的刷新间隔
+STT_TEXT_QUEUE_SIZE = 64  # 识别结果和说话开始/结束标志，引擎随到随取，正常不会积压
+
+
+class UIDispatcher:
+    """
+        Tk 不是线程安全的：工作线程只通过 post/insert 投递界面更新，
+        主线程用 root.after 按固定间隔统一执行，同一文本框的连续 insert 合并为一次。
+    """
+
+    def __init__(self, root, interval_ms=UI_REFRESH_MS):
+        self.root = root
+        self.interval_ms = interval_ms
+        self.events = queue.Queue()
+        self.posted = 0     # 投递的更新数
+        self.applied = 0    # 实际执行的更新数
+        self.root.after(self.interval_ms, self.drain)
+
+    @property
+    def coalesced(self) -> int:
+        return self.posted - self.applied
+
+    def post(self, func, *args):
+        """ 在主线程执行 func(*args) """
+        self.events.put((None, func, args))
+
+    def insert(self, widget, text, see=True):
+        """ 追加文本到文本框末尾 """
+        self.events.put((widget, text, see))
+
+    def drain(self):
+        pending_widget, pending_text, pending_see = None, [], False
+        try:
+            while True:
+                try:
+                    widget, item, arg = self.events.get_nowait()
+                except queue.Empty:
+                    break
+                self.posted += 1
+                if widget is not None and widget is pending_widget:
+                    pending_text.append(item)
+                    pending_see = pending_see or arg
+                    continue
+                self.apply_insert(pending_widget, pending_text, pending_see)
+                if widget is not None:
+                    pending_widget, pending_text, pending_see = widget, [
+                        item], arg
+                else:
+                    pending_widget, pending_text, pending_see = None, [], False
+                    self.applied += 1
+                    try:
+                        item(*arg)
+                    except Exception as e:
+                        print(f"Error in UI update: {e}", file=sys.stderr)
+            self.apply_insert(pending_widget, pending_text, pending_see)
+        finally:
+            self.root.after(self.interval_ms, self.drain)
+
+    def apply_insert(self, widget, texts, see):
+        if widget is None or not texts:
+            return
+        self.applied += 1
+        widget.insert(ctk.END, "".join(texts))
+        if see:
+            widget.see(ctk.END)
+
+    def report(self) -> str:
+        return f"UI updates: posted {self.posted}, applied {self.applied}, coalesced {self.coalesced}"
+
 
 def ui_mainloop():
     root = ctk.CTk()
     config = utils.load_config()
+    client.configure(host=config.get("ollama_host"),
+                     connect_timeout=config.get("ollama_connect_timeout"),
+                     read_timeout=config.get("ollama_read_timeout"),
+                     keep_alive=config.get("ollama_keep_alive"))
+    if config.get("vram_budget_gb"):
+        # 0 表示根据 /api/ps 和实际换出情况自动判断
+        residency.planner.vram_budget = config["vram_budget_gb"] * 1024 ** 3
     app = MainGUI(root, config)
     root.iconbitmap('logo.ico')
     root.mainloop()
@@ -39,9 +122,26 @@ class MainGUI:
         self.root = root
         self.config = config
         self.character = {}
+        self.tts = None
+        self.engine = None
         self.extract_dialogue_for_tts = False
         self.auto_send_message = False
         self.query_memory_before_send_message = False
+        # True: 使用 /api/chat 并保留多轮 messages，复用 Ollama 的 KV cache；False: 旧的 /api/generate
+        self.reuse_context = bool(config.get("reuse_context", True)) if config else True
+        self.history = chat.ConversationHistory()
+        self.response_cache = None
+        self.idle_cpu = pipeline.CpuMeter()
+        self.character_folder = None
+        self.building_model = False  # 同一时间只运行一个构建
+        # 记忆检索在识别出文本时就开始，与历史裁剪等并行，不占用生成首字的关键路径
+        self.retrieval_executor = ThreadPoolExecutor(
+            max_workers=RETRIEVAL_WORKERS, thread_name_prefix="retrieval")
+        self.retrievals = {}  # query -> Future
+        self.retrieval_lock = threading.Lock()
+
+        # 工作线程对界面的修改都经由 dispatcher 回到主线程
+        self.dispatcher = UIDispatcher(self.root)
 
         # Configure window size
         self.root.geometry("800x480+1000+500")
@@ -73,19 +173,38 @@ class MainGUI:
         # Initialize STT and audio player
         self.asr = Faster_Whisper_STT(
             self.input_text_queue, self.config["stt_model_path"])
-        self.audio_player = AudioPlayer(self.audio_queue)
+        self.audio_player = AudioPlayer(
+            self.audio_queue,
+            sample_rate=self.config.get("audio_output_rate") or None,  # 0：跟随 TTS 的采样率
+            trim=self.config.get("trim_silence", True))
 
         # Initialize TTS (delayed until after character file is loaded)
-        self.tts = GPT_Sovits_TTS(self.character, self.audio_queue)
+        self.tts = GPT_Sovits_TTS(
+            self.character, self.audio_queue,
+            cache_bytes=int(self.config.get("tts_cache_mb", 64)) * 1024 * 1024,
+            queue_size=int(self.config.get("tts_queue_size", 64)),
+            queue_policy=self.config.get("tts_queue_policy", pipeline.POLICY_MERGE))
 
         # Start the audio player
         self.audio_player.start()  # Start the audio player
         self.tts.start()  # Start TTS
-
-        # Start a thread to listen for STT output
-        self.stt_listener_thread = threading.Thread(
-            target=self.listen_stt_output, daemon=True)
-        self.stt_listener_thread.start()
+        self.tts.prepare_character()
+
+        # 对话引擎：每轮对话是事件循环中的一个任务，同时把识别结果转给界面
+        self.engine = ConversationEngine(self, self.input_text_queue)
+        self.engine.start()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
+
+    def on_closing(self):
+        """ 关闭窗口：先停止引擎和各工作线程，再销毁窗口 """
+        self.engine.stop()
+        if self.response_cache is not None:
+            self.response_cache.flush()
+        self.asr.stop()
+        if not self.tts.stop_event.is_set():
+            self.tts.stop()
+        self.audio_player.stop()
+        self.root.destroy()
 
     def log(self, info: str, title=""):
         """ Log information """
@@ -176,6 +295,11 @@ class MainGUI:
             command=self.send_message,
             width=120, height=40,)
         self.send_button.grid(row=0, column=5, padx=10, pady=10)
+
+        # 各环节队列的实时深度
+        self.queue_depth_label = ctk.CTkLabel(
+            self.button_frame, text="", font=Font_YaHei_11)
+        self.queue_depth_label.grid(row=1, column=0, columnspan=6, padx=10, sticky="e")
         # Bind shortcut keys
         # Enter key to send message
         self.input_text.bind("<Return>", self.send_message)
@@ -184,8 +308,19 @@ class MainGUI:
         self.root.bind(
             self.config["key_tts"], self.toggle_audio_playback)  # Ctrl+P shortcut for stopping audio playback
 
-        self.input_text_queue = queue.Queue()
-        self.audio_queue = queue.Queue()
+        self.input_text_queue = pipeline.BoundedQueue("STT text", STT_TEXT_QUEUE_SIZE)
+        # 播放比合成慢时限制内存中的音频句数，满了默认阻塞合成线程，spill 时写到临时文件
+        self.audio_queue = pipeline.BoundedQueue(
+            "Audio", int(self.config.get("audio_queue_size", 8)),
+            self.config.get("audio_queue_policy", pipeline.POLICY_BLOCK),
+            spill=spill_clip)
+        self.update_queue_gauges()
+
+    def update_queue_gauges(self):
+        text = pipeline.queue_gauges()
+        if self.queue_depth_label.cget("text") != text:
+            self.queue_depth_label.configure(text=text)
+        self.root.after(QUEUE_GAUGE_MS, self.update_queue_gauges)
 
     def build_character_tab(self):
         self.character_tab.rowconfigure(0, weight=1)
@@ -815,23 +950,76 @@ class MainGUI:
         if not content:
             return
 
-        # Generate summary using the model specified in character settings
-        prompt = chat.generate_summary_prompt(content)
-        response = chat.generate_completion(
-            prompt, model=self.character['name'], stream=False)
-        if response.status_code == 200:
-            summary = f"\n{response.json()['response']}"
-
-            # 插入新文本到原来选中内容的位置
-            self.memo_text.delete(start_pos, end_pos)
-            self.memo_text.insert(start_pos, summary)
-            # 设置插入的内容为选中状态
-            end_pos = self.memo_text.index(
-                f"{start_pos} + {len(summary)} chars")
-            self.memo_text.tag_add("sel", start_pos, end_pos)
-            self.memo_text.see(start_pos)  # 确保选中内容在可视范围内
+        # 在后台线程中摘要，界面不再卡住
+        self.summary_button.configure(state="disabled")
+        threading.Thread(target=self.summary_memo_process,
+                         args=(content, start_pos, end_pos), daemon=True).start()
+
+    def summary_memo_process(self, content, start_pos, end_pos):
+        try:
+            # Generate summary using the model specified in character settings
+            prompt = chat.generate_summary_prompt(content)
+            summary = self.get_cached_response(prompt)  # 内容没变时直接使用上次的摘要
+            if summary is None:
+                parameters = self.character.get("parameters", {})
+                summary = chat.summarize(
+                    content, self.character['name'], mem.split_text,
+                    num_ctx=parameters.get(
+                        "num_ctx", chat.DEFAULT_NUM_CTX),
+                    num_predict=parameters.get(
+                        "num_predict", chat.DEFAULT_NUM_PREDICT),
+                    on_progress=lambda done, total, level: self.dispatcher.post(
+                        self.set_summary_progress, f"Summary {'merge ' * level}{done}/{total}"))
+                self.put_cached_response(prompt, summary)
+            if summary.strip():
+                self.dispatcher.post(self.insert_summary,
+                                     f"\n{summary}", start_pos, end_pos)
+        except Exception as e:
+            print("Error generating summary:", e)
+            self.dispatcher.post(messagebox.showerror,
+                                 "Summary failed", str(e))
+        finally:
+            self.dispatcher.post(self.set_summary_progress,
+                                 "Summary", "normal")
+
+    def set_summary_progress(self, text, state=None):
+        if state:
+            self.summary_button.configure(text=text, state=state)
         else:
-            print("Error generating summary:", response.status_code)
+            self.summary_button.configure(text=text)
+
+    def insert_summary(self, summary, start_pos, end_pos):
+        # 插入新文本到原来选中内容的位置
+        self.memo_text.delete(start_pos, end_pos)
+        self.memo_text.insert(start_pos, summary)
+        # 设置插入的内容为选中状态
+        end_pos = self.memo_text.index(
+            f"{start_pos} + {len(summary)} chars")
+        self.memo_text.tag_add("sel", start_pos, end_pos)
+        self.memo_text.see(start_pos)  # 确保选中内容在可视范围内
+
+    def get_model_digest(self):
+        """ 角色模型的 digest，重新 build 后变化，回复缓存按它区分 """
+        try:
+            return models.inventory.digest(self.character['name'])
+        except Exception as e:
+            print(f"Error getting digest of model: {e}")
+            return None
+
+    def get_cached_response(self, prompt, context=""):
+        if self.response_cache is None:
+            return None
+        response = self.response_cache.get(
+            self.get_model_digest(), self.character.get("parameters"), prompt, context)
+        if response is not None:
+            print(self.response_cache.report())
+        return response
+
+    def put_cached_response(self, prompt, response, context=""):
+        if self.response_cache is None:
+            return
+        self.response_cache.put(
+            self.get_model_digest(), self.character.get("parameters"), prompt, response, context)
 
     def save_to_vector_store(self):
         text = self.memo_text.get("1.0", ctk.END).strip()
@@ -895,25 +1083,66 @@ class MainGUI:
                 query = self.query_message_box.get().strip()
 
         if query:
-            # 如果选中的文本不为空，则将其插入到query_message_box框中
-            self.query_message_box.delete(0, ctk.END)
-            self.query_message_box.insert(0, query)
-            self.query_result = mem.get_relevant_context_from_vector_store(
+            query_result = mem.get_relevant_context_from_vector_store(
                 store_path=self.memo_path, query=query, chroma=self.mem_vector_store)
-
-            # 清空 memo_text
-            self.memo_text.delete("1.0", ctk.END)
-
-            # 格式化查询结果并插入到 memo_text
-            if self.query_result:
-                result_text = "\n".join(
-                    [f"\nID: {doc.id} similarity: {similarity:.4f}\n{doc.page_content}\n" for doc, similarity in self.query_result])
-                self.memo_text.insert(ctk.END, result_text)
-            else:
-                self.memo_text.insert(ctk.END, "No relevant documents found.")
+            self.show_query_result(query, query_result)
         else:
             pass
 
+    def query_memory(self, query) -> str:
+        """ 在工作线程中检索记忆，结果直接返回给提示词，界面展示交给 dispatcher """
+        residency.planner.plan()
+        query_result = mem.get_relevant_context_from_vector_store(
+            store_path=self.memo_path, query=query, chroma=self.mem_vector_store)
+        self.dispatcher.post(self.show_query_result, query, query_result)
+        if not query_result:
+            return "No relevant documents found."
+        return self.format_query_result(query_result).strip()
+
+    def prefetch_memory(self, query):
+        """ 提前在线程池中开始检索，返回 Future；相同的 query 复用同一个检索 """
+        if not self.query_memory_before_send_message:
+            return None
+        query = query.strip()
+        if not query:
+            return None
+        with self.retrieval_lock:
+            future = self.retrievals.get(query)
+            if future is None:
+                future = self.retrieval_executor.submit(
+                    self.query_memory, query)
+                self.retrievals[query] = future
+                while len(self.retrievals) > MAX_PENDING_RETRIEVALS:
+                    self.retrievals.pop(next(iter(self.retrievals)))
+        return future
+
+    def take_memory(self, query):
+        """ 取出（没有则开始）本轮的检索 """
+        future = self.prefetch_memory(query)
+        with self.retrieval_lock:
+            self.retrievals.pop(query.strip(), None)
+        return future
+
+    def format_query_result(self, query_result) -> str:
+        return "\n".join(
+            [f"\nID: {doc.id} similarity: {similarity:.4f}\n{doc.page_content}\n" for doc, similarity in query_result])
+
+    def show_query_result(self, query, query_result):
+        # 如果选中的文本不为空，则将其插入到query_message_box框中
+        self.query_message_box.delete(0, ctk.END)
+        self.query_message_box.insert(0, query)
+        self.query_result = query_result
+
+        # 清空 memo_text
+        self.memo_text.delete("1.0", ctk.END)
+
+        # 格式化查询结果并插入到 memo_text
+        if self.query_result:
+            self.memo_text.insert(
+                ctk.END, self.format_query_result(self.query_result))
+        else:
+            self.memo_text.insert(ctk.END, "No relevant documents found.")
+
     def select_audio_file(self):
         file_path = filedialog.askopenfilename(
             title="Select Audio File",
@@ -925,6 +1154,7 @@ class MainGUI:
             self.character["ref_audio_path"] = file_path
             self.character["prompt_text"] = os.path.basename(
                 file_path).split('.')[0]  # Use the filename as prompt_text
+            self.tts.prepare_character()
 
     def select_audio_lang(self, *args):
         selected_language = self.ref_audio_lang_var.get()
@@ -961,30 +1191,84 @@ class MainGUI:
         if os.path.exists(file_path):
             try:
                 data = utils.load_settings_from_file(file_path)
+                # 上一个角色的回复不能继续播放，也不能写进新角色的历史
+                self.cancel_current_turn()
                 self.update_ui_with_data(data, file_path)
-                character_exists = self.check_model_exists(data["name"])
-                base_model_exists = self.check_model_exists(data["from_model"])
-                build_success = False
-
-                if not character_exists:
-                    if not base_model_exists:
-                        messagebox.showerror(
-                            "Error", f"{data['from_model']} Not Found, Import Failed!\nSee logs for more details.")
-                        self.log(
-                            f"Create character {data['name']} from {file_path} Failed,\nBase model {data['from_model']} not found,You may need to  install it by following instructions:\n ollama run {data['from_model']}")
-                        return
-                    else:
-                        build_success = self.build_model()
-                if build_success or (character_exists and base_model_exists):
-                    character_path = utils.get_relative_path(file_path)
-                    if self.config["character"] != character_path:
-                        self.config["character"] = character_path
-                        utils.save_config(self.config)
-                    self.log(
-                        f"Character {data['name']} loaded from {file_path}")
+                spec = self.get_model_spec()
             except Exception as e:
                 messagebox.showerror("Error", f"Not a valid character card!")
                 print(f"Error loading character card from {file_path}: {e}")
+                return
+            # 检查和构建模型放到后台，角色定义没有变化时不重新构建
+            threading.Thread(target=self.prepare_character_model,
+                             args=(spec, file_path), daemon=True).start()
+
+    def prepare_character_model(self, spec, file_path):
+        model_name = spec["model_name"]
+        from_model = spec["from_model"]
+        folder = os.path.dirname(file_path)
+        try:
+            character_exists = models.inventory.exists(model_name)
+            base_model_exists = models.inventory.exists(from_model)
+        except Exception as e:
+            self.dispatcher.post(messagebox.showerror, "Error",
+                                 f"Error checking model existence: {e}")
+            return
+        digest = models.modelfile_digest(
+            from_model, spec["parameters"], spec["template"], spec["system"])
+        build_digest = models.load_build_digest(folder, model_name)
+
+        # 没有构建记录的已有模型沿用以前的行为，直接使用
+        if character_exists and build_digest in (None, digest):
+            self.dispatcher.post(self.on_character_ready, model_name, file_path)
+            return
+        if not base_model_exists:
+            self.dispatcher.post(messagebox.showerror,
+                                 "Error", f"{from_model} Not Found, Import Failed!\nSee logs for more details.")
+            self.dispatcher.post(self.log,
+                                 f"Create character {model_name} from {file_path} Failed,\nBase model {from_model} not found,You may need to  install it by following instructions:\n ollama run {from_model}")
+            return
+        self.dispatcher.post(self.start_build, spec, folder,
+                             lambda: self.on_character_ready(model_name, file_path))
+
+    def on_character_ready(self, model_name, file_path):
+        character_path = utils.get_relative_path(file_path)
+        if self.config["character"] != character_path:
+            self.config["character"] = character_path
+            utils.save_config(self.config)
+        self.log(f"Character {model_name} loaded from {file_path}")
+        self.warm_up_models(model_name)
+
+    def warm_up_models(self, model_name):
+        """ 后台预加载角色模型（以及有记忆库时的 embedding 模型），记录实际耗时 """
+        warm_up_embedding = self.mem_vector_store is not None or self.query_memory_before_send_message
+
+        def warm_up():
+            try:
+                residency.planner.set_models(
+                    chat_model=model_name, embedding_model=mem.DEFAULT_EMBEDDING_MODEL)
+                wall_ms = chat.warm_up(model_name)
+                residency.planner.mark_loaded(model_name)
+                self.dispatcher.post(
+                    self.log, f"{model_name} loaded in {wall_ms:.0f}ms, keep_alive: {client.KEEP_ALIVE}", "Warm up")
+                if warm_up_embedding:
+                    self.warm_up_embedding_model()
+            except Exception as e:
+                print(f"Error warming up model {model_name}: {e}")
+
+        threading.Thread(target=warm_up, daemon=True).start()
+
+    def warm_up_embedding_model(self):
+        try:
+            wall_ms = mem.warm_up_embedding()
+            self.dispatcher.post(
+                self.log, f"{mem.DEFAULT_EMBEDDING_MODEL} loaded in {wall_ms:.0f}ms", "Warm up")
+            # 两个模型都加载后检查是否能同时驻留
+            residency.planner.plan(force=True)
+            self.dispatcher.post(
+                self.log, residency.planner.report(), "Model residency")
+        except Exception as e:
+            print(f"Error warming up embedding model: {e}")
 
     def load_character_file(self, file_path=None):
         if not file_path:
@@ -1036,6 +1320,7 @@ class MainGUI:
             "ref_audio": self.ref_audio_var.get(),
             "ref_audio_lang": self.ref_audio_lang_var.get(),
             "speed_factor": self.speed_factor_var.get(),
+            "tts_streaming": self.character.get("streaming_mode", False),
             "from_model": self.model_from_var.get(),
             "parameters": parameters,
             "template": self.model_template_var.get(),
@@ -1125,73 +1410,109 @@ class MainGUI:
     def check_model_exists(self, model_name):
         try:
             # Check if same named model exists
-            models_response = ollama.list()  # Get installed model list
-            models = models_response.models  # Get model list
-
-            return any(
-                model.model == model_name or
-                model.model == f"{model_name}:latest"
-                for model in models)
+            return models.inventory.exists(model_name)
         except Exception as e:
             messagebox.showerror(
                 "Error", f"Error checking model existence: {e}"
             )
             return False
 
+    def get_model_spec(self):
+        """ 界面上的角色模型定义，在 Tk 线程调用 """
+        return {
+            "model_name": self.character_name_var.get(),
+            "from_model": self.model_from_var.get().strip(),
+            "parameters": self.get_model_parameters(),
+            "template": self.model_template_var.get(),
+            # messages=self.model_message_var.get(), #格式有误，先屏蔽掉
+            "system": self.model_profile_text.get("1.0", ctk.END),
+        }
+
     def build_model(self):
         # Model building logic
+        if self.building_model:
+            self.log("Another model is being built, please wait", "Build")
+            return False
         try:
-            parameters = self.get_model_parameters()
+            spec = self.get_model_spec()
         except ValueError as e:
             messagebox.showerror("Build failed", str(e))
             return False
 
-        try:
-            from_model = self.model_from_var.get().strip()
-            if from_model:  # Check if there is a source model
-                from_model_exists = self.check_model_exists(from_model)
-                if not from_model_exists:
-                    messagebox.showerror(
-                        "Build failed", f"Base model '{from_model}' not found. Please check installation:\n ollama run {from_model}")
-                    return False
-
-                # Check for existing same named model
-            model_name = self.character_name_var.get()
-            existing_model = self.check_model_exists(model_name)
-
-            if existing_model:
-                # Show dialog to ask whether to overwrite
-                response = messagebox.askyesno(
-                    "Model already exists", f"Model '{model_name}' already exists. Do you want to replace it?")
-                if not response:
-                    self.log(
-                        f"User cancelled building of model '{model_name}", "Build cancelled")
-                    return False
+        from_model = spec["from_model"]
+        if from_model:  # Check if there is a source model
+            from_model_exists = self.check_model_exists(from_model)
+            if not from_model_exists:
+                messagebox.showerror(
+                    "Build failed", f"Base model '{from_model}' not found. Please check installation:\n ollama run {from_model}")
+                return False
 
-            self.log(
-                f"Creating ollama model '{model_name}' ... ", "Starting build...")
-
-            # Build the model
-            progress_response = ollama.create(
-                model=model_name,
-                from_=self.model_from_var.get(),
-                parameters=parameters,
-                template=self.model_template_var.get(),
-                # messages=self.model_message_var.get(), #格式有误，先屏蔽掉
-                system=self.model_profile_text.get("1.0", ctk.END),
-            )
-            self.log(f"Model '{model_name}' created successfully", "done")
-            return True
+        # Check for existing same named model
+        model_name = spec["model_name"]
+        existing_model = self.check_model_exists(model_name)
+
+        if existing_model:
+            digest = models.modelfile_digest(
+                from_model, spec["parameters"], spec["template"], spec["system"])
+            if models.load_build_digest(self.character_folder, model_name) == digest:
+                self.log(
+                    f"Model '{model_name}' is up to date", "Build skipped")
+                return True
+            # Show dialog to ask whether to overwrite
+            response = messagebox.askyesno(
+                "Model already exists", f"Model '{model_name}' already exists. Do you want to replace it?")
+            if not response:
+                self.log(
+                    f"User cancelled building of model '{model_name}", "Build cancelled")
+                return False
 
+        self.start_build(spec, self.character_folder)
+        return True
+
+    def start_build(self, spec, folder, on_success=None):
+        """ 在后台线程流式构建模型，进度输出到日志 """
+        if self.building_model:
+            self.log("Another model is being built, please wait", "Build")
+            return
+        self.building_model = True
+        self.log(
+            f"Creating ollama model '{spec['model_name']}' ... ", "Starting build...")
+        threading.Thread(target=self.build_model_process,
+                         args=(spec, folder, on_success), daemon=True).start()
+
+    def build_model_process(self, spec, folder, on_success=None):
+        model_name = spec["model_name"]
+        start = time.perf_counter()
+        try:
+            models.create_model(
+                model_name, spec["from_model"],
+                parameters=spec["parameters"],
+                template=spec["template"],
+                system=spec["system"],
+                on_progress=lambda text: self.dispatcher.post(
+                    self.log, text, f"Building {model_name}"))
         except Exception as e:
-            messagebox.showerror(
-                "Build failed", f"An error occurred while building the model: {e}")
-            return False,
+            self.dispatcher.post(self.on_model_built, model_name, None)
+            self.dispatcher.post(messagebox.showerror,
+                                 "Build failed", f"An error occurred while building the model: {e}")
+            return
+        models.save_build_digest(folder, model_name, models.modelfile_digest(
+            spec["from_model"], spec["parameters"], spec["template"], spec["system"]))
+        self.dispatcher.post(self.on_model_built, model_name,
+                             (time.perf_counter() - start) * 1000)
+        if on_success:
+            self.dispatcher.post(on_success)
+
+    def on_model_built(self, model_name, elapsed_ms):
+        self.building_model = False
+        if elapsed_ms is None:
+            return
+        self.log(
+            f"Model '{model_name}' created successfully in {elapsed_ms:.0f}ms", "done")
 
     def list_installed_models(self):
         try:
-            models_response = ollama.list()  # Get installed model list
-            models = models_response.models  # Get model list
+            installed_models = models.list_models()  # Get installed model list (cached)
 
             # Format model information as string
             models_str = "\n".join(
@@ -1201,7 +1522,7 @@ class MainGUI:
                     f"Digest: {model.digest if model.digest else 'N/A'}, "
                     f"Size: {model.size if model.size else 'N/A'}, "
                     f"Details: {model.details if model.details else 'N/A'}"
-                    for model in models
+                    for model in installed_models
                 ]
             )
             models_str_log = "\n".join(
@@ -1209,7 +1530,7 @@ class MainGUI:
                     f"{model.model}  "
                     f"{model.details.parameter_size if model.details else 'N/A'}  "
                     f"{model.details.family if model.details else 'N/A'}"
-                    for model in reversed(models)
+                    for model in reversed(installed_models)
                 ])  # Simplified model name list
 
             print(f"Installed models list:\n{models_str}")  # Print to console
@@ -1261,8 +1582,31 @@ class MainGUI:
         self.character["prompt_lang"] = self.ref_audio_lang_var.get()
         self.character["prompt_text"] = self.ref_prompt_text_var.get()
         self.character["speed_factor"] = self.speed_factor_var.get()
+        # 角色卡可选项：GPT-SoVITS 流式合成，首句更快出声
+        self.character["streaming_mode"] = bool(data.get("tts_streaming", False))
+        if self.tts is not None:  # 启动时 TTS 在加载角色之后才创建
+            self.tts.prepare_character()
+
+        # 切换角色后开始新的对话，预算按角色的 num_ctx 计算
+        self.history = chat.ConversationHistory.from_character(data)
+
+        # 回复缓存（可选）保存在角色目录下；模型重新 build 后 digest 会变化
+        self.character["parameters"] = data["parameters"]
+        # response_cache_semantic 每次精确匹配未命中都要先请求一次 embedding，会增加首字延迟
+        if self.response_cache is not None:
+            self.response_cache.flush()
+        if self.config.get("response_cache"):
+            self.response_cache = cache.ResponseCache(
+                folder=os.path.dirname(path),
+                embedding_function=mem.OllamaEmbeddingFunction() if self.config.get(
+                    "response_cache_semantic") else None,
+                cache_nondeterministic=self.config.get("response_cache_nondeterministic", False))
+        else:
+            self.response_cache = None
 
-        self.memo_path = mem.get_store_path(os.path.dirname(path))
+        self.character_folder = os.path.dirname(path)
+        self.character["folder"] = self.character_folder  # TTS 缓存保存在角色目录下
+        self.memo_path = mem.get_store_path(self.character_folder)
         if mem.check_vector_store_exists(self.memo_path):
             self.mem_vector_store = mem.load_vector_store(self.memo_path)
         else:
@@ -1275,6 +1619,8 @@ class MainGUI:
         else:
             self.memory_switch.select()
             self.query_memory_before_send_message = True
+            threading.Thread(target=self.warm_up_embedding_model,
+                             daemon=True).start()
 
     def toggle_recording(self, event=None):
         if self.asr.is_recording:
@@ -1320,141 +1666,85 @@ class MainGUI:
             # if the input is empty or contains only whitespace, do nothing
             return
         self.input_text.delete(0, ctk.END)
-        self.history_text.insert(ctk.END, "\n")
-        self.history_text.insert(ctk.END, f"You:\n")
-        self.history_text.insert(ctk.END, f" {user_input}\n")
-        self.history_text.see(ctk.END)
-        threading.Thread(target=self.send_message_to_model,
-                         args=(user_input,), daemon=True).start()
+        # 两轮对话之间的 CPU 占用，各线程阻塞等待时应接近 0
+        print(f"Idle since last turn: {self.idle_cpu.report()}")
+        self.prefetch_memory(user_input)
+        # 新的一轮开始，上一轮如果还在生成则先取消，它之后的输出不会再显示
+        self.cancel_current_turn()
+        # 经由 dispatcher 插入，保证与上一轮尚未刷新的流式文本保持顺序
+        self.dispatcher.insert(self.history_text, f"\nYou:\n {user_input}\n")
+        self.engine.submit(user_input)
+
+    def cancel_current_turn(self):
+        """ 打断当前回复：关闭 LLM 流，丢弃待合成的句子，立即清空播放 """
+        if self.engine is None:
+            return  # 启动时加载角色卡，引擎还没有创建
+        self.engine.cancel()
+        self.tts.clear_text_queue()
+        self.audio_player.flush()
+
+    def on_reply_start(self, turn):
+        self.dispatcher.insert(
+            self.history_text, f"{self.character['name']}: \n")
+
+    def on_reply(self, text, see=False):
+        if text:
+            self.dispatcher.insert(self.history_text, text, see=False)
+        if see:
+            self.dispatcher.post(self.history_text.see, ctk.END)
+
+    def on_turn_error(self, turn, error):
+        self.dispatcher.post(messagebox.showerror,
+                             "message send failed!", str(error))
+
+    def on_turn_end(self, turn):
+        if turn.first_token_ms is not None:
+            print(f"Turn {turn.id}: first token {turn.first_token_ms:.0f}ms, "
+                  f"total {turn.elapsed_ms:.0f}ms")
+        print(self.engine.report())
+        print(self.dispatcher.report())
+        print(self.tts.report())
+        print(self.audio_player.report())
+        print(self.input_text_queue.report())
+        self.idle_cpu.start()
+        if self.query_memory_before_send_message:
+            print(residency.planner.report())
 
-    def extract_think_tags(text):
-        # 使用正则表达式匹配 <think> 和 </think> 标签及其内容
-        pattern = r'<think>(.*?)</think>'
-        matches = re.findall(pattern, text, re.DOTALL)
+    def speak(self, sentence, token=None):
+        """ 把分好的句子送去合成 """
+        if self.extract_dialogue_for_tts:
+            for dialogue in utils.extract_dialogue_from_text(sentence):
+                self.tts.add_text_to_queue(dialogue, token)
+        else:
+            self.tts.add_text_to_queue(sentence, token)
 
-        if not matches:
-            return text, []
+    def on_speech_start(self):
+        if self.auto_send_message:
+            self.cancel_current_turn()  # barge-in
 
-        extracted_parts = [f"<think>{match}</think>" for match in matches]
-        remaining_text = re.sub(pattern, "", text)
+    def on_speech_end(self):
+        if self.auto_send_message:
+            self.dispatcher.post(self.send_message)
 
-        return remaining_text, extracted_parts
+    def on_recognized(self, recognized_text):
+        # 识别出文本就开始检索记忆，不等待发送
+        self.prefetch_memory(recognized_text)
+        self.dispatcher.post(self.insert_recognized_text, recognized_text)
 
-    def send_message_to_model(self, user_input):
-        prompt = user_input.strip()
+    def insert_recognized_text(self, recognized_text):
+        # 检查是否有选中的文本
         try:
-            conversation_history = self.history_text.get(
-                "1.0", ctk.END).strip()
-            conversation_history_str = ""
-            if conversation_history:
-                # Get last chunk of conversation history
-                conversation_history_str = mem.split_text(
-                    conversation_history)[-1:]
-
-            # Retrieve relevant context from the vector store
-            if self.query_memory_before_send_message and conversation_history_str:
-                self.perform_query(query=str(user_input))
-                relevant_documents_str = self.memo_text.get(
-                    "1.0", ctk.END).strip()
-
-                prompt = chat.generate_contextual_prompt(
-                    user_input=user_input, conversation_history=conversation_history_str, relevant_documents=relevant_documents_str)
-
-            response = chat.generate_completion(
-                prompt, self.character['name'])
-            if response.status_code == 200:
-                self.history_text.insert(
-                    ctk.END, f"{self.character['name']}: \n")
-                sentence_buffer = ""
-                is_thinking = True
-                for chunk in response.iter_lines():
-                    if chunk:
-                        try:
-                            json_data = json.loads(chunk.decode('utf-8'))
-                            if "response" in json_data:
-                                text_part = json_data["response"]
-                                sentence_buffer += text_part
-                                if is_thinking and sentence_buffer.startswith("<think>"):
-                                    think_end_index = sentence_buffer.find(
-                                        "</think>")
-                                    if think_end_index != -1:
-                                        len_end_tag = len("</think>")
-                                        sentence_buffer = sentence_buffer[think_end_index+len_end_tag:]
-                                        is_thinking = False
-                                        if len(text_part) < len_end_tag:
-                                            print(text_part, flush=True)
-                                        else:
-                                            print(text_part[:text_part.find(
-                                                "</think>")+len_end_tag], flush=True)
-                                    else:
-                                        print(text_part, flush=True, end='')
-                                else:
-                                    self.history_text.insert(
-                                        ctk.END, f"{text_part}")
-
-                                    if re.search(r"[”）)。？！」.~]$", sentence_buffer):
-                                        if self.extract_dialogue_for_tts:
-                                            dialogues = utils.extract_dialogue_from_text(
-                                                sentence_buffer)
-                                            if len(dialogues) > 0:
-                                                for dialogue in dialogues:
-                                                    self.tts.add_text_to_queue(
-                                                        dialogue)
-                                                sentence_buffer = ""
-                                        else:
-                                            self.tts.add_text_to_queue(
-                                                sentence_buffer)
-                                            sentence_buffer = ""
-                                        self.history_text.see(ctk.END)
-                                    elif json_data.get("done", False):
-                                        dialogues = utils.extract_dialogue_from_text(
-                                            sentence_buffer)
-                                        for dialogue in dialogues:
-                                            self.tts.add_text_to_queue(
-                                                dialogue)
-                                        sentence_buffer = ""
-                                        break
-                        except json.JSONDecodeError:
-                            print(
-                                f"JSON decoding error: {chunk}", file=sys.stderr)
-                            continue
-            else:
-                print(f"message send failed! Response: {response}")
-
+            start_pos = self.input_text.index(
+                "sel.first")  # 获取选中文本的起始位置
+            end_pos = self.input_text.index(
+                "sel.last")    # 获取选中文本的结束位置
+            # 删除选中的文本
+            self.input_text.delete(start_pos, end_pos)
         except Exception as e:
-            messagebox.showerror("message send failed!", str(e))
-            print("message send failed!", str(e))
-
-    def listen_stt_output(self):
-        while True:
-            if not self.input_text_queue.empty():
-                recognized_text = self.input_text_queue.get()
-                if recognized_text == SPEECH_START:
-                    if self.auto_send_message:
-                        self.tts.clear_text_queue()
-                        self.audio_queue.queue.clear()
-                    # print("Speech started")
-                    continue
-                elif recognized_text == SPEECH_END:
-                    # print("Speech ended")
-                    if self.auto_send_message:
-                        self.send_message()
-                else:
-                    # 检查是否有选中的文本
-                    try:
-                        start_pos = self.input_text.index(
-                            "sel.first")  # 获取选中文本的起始位置
-                        end_pos = self.input_text.index(
-                            "sel.last")    # 获取选中文本的结束位置
-                        # 删除选中的文本
-                        self.input_text.delete(start_pos, end_pos)
-                    except Exception as e:
-                        # 如果没有选中的文本，捕获异常并忽略
-                        pass
-
-                    # 插入新文本到光标位置
-                    self.input_text.insert(ctk.INSERT, recognized_text)
+            # 如果没有选中的文本，捕获异常并忽略
+            pass
 
-            time.sleep(0.2)
+        # 插入新文本到光标位置
+        self.input_text.insert(ctk.INSERT, recognized_text)
     if __name__ == "__main__":
         ui_mainloop()
@@ -1,106 +1,442 @@
+import os
+import tempfile
 import pyaudio
 import threading
 import time
-import sys
 import queue
-from pydub import AudioSegment
-from pydub.playback import play
-from io import BytesIO
+import numpy as np
+from pipeline import Spilled
 
-CHUNK_SIZE = 1024
-RATE = 32000
+CHUNK_SIZE = 512  # 输出回调每个周期的帧数（32kHz 下 16ms），stop/flush 在一个周期内生效
+RING_SECONDS = 1.0  # 环形缓冲区能容纳的音频时长
+IDLE_TIMEOUT = 1.0  # 播放线程阻塞等待音频的最长时间
+RATE = 32000  # 输出流的初始采样率，之后按 TTS 返回的格式重新打开
+STREAM_READ_TIMEOUT = 0.1  # 等待流式数据时检查 stop/flush 的间隔（秒）
+CROSS_FADE_MS = 50
+SILENCE_THRESHOLD = 200  # 约 -44 dBFS，低于这个幅度视为静音
+SILENCE_PAD_MS = 60      # 去掉首尾静音后保留的长度，避免截掉轻声的开头/结尾
+
+
+class PCMClip:
+    """ 一整句的 PCM：交错排列的 int16 数组（通常直接引用下载的字节）和采样格式 """
+
+    def __init__(self, samples: np.ndarray, sample_rate=RATE, channels=1):
+        self.samples = samples
+        self.sample_rate = sample_rate
+        self.channels = channels
+
+    @property
+    def frame_width(self) -> int:
+        return self.channels * self.samples.itemsize
+
+    @property
+    def duration_ms(self) -> float:
+        return len(self.samples) / self.channels / self.sample_rate * 1000
+
+
+def trim_silence(samples: np.ndarray, sample_rate, channels=1,
+                 threshold=SILENCE_THRESHOLD, pad_ms=SILENCE_PAD_MS) -> np.ndarray:
+    """ 去掉首尾低于阈值的静音，两端各保留 pad_ms；返回原数组的切片，不复制 """
+    frames = samples[:len(samples) - len(samples) % channels].reshape(-1, channels)
+    # 不用 abs()，避免 -32768 溢出
+    loud = np.flatnonzero(((frames > threshold) | (frames < -threshold)).any(axis=1))
+    if len(loud) == 0:
+        return samples[:0]
+    pad = int(sample_rate * pad_ms / 1000)
+    start = max(0, loud[0] - pad)
+    end = min(len(frames), loud[-1] + 1 + pad)
+    return samples[start * channels:end * channels]
+
+
+def resample(samples: np.ndarray, src_rate, dst_rate, channels=1) -> np.ndarray:
+    """ 线性插值重采样，只在 TTS 采样率与固定的输出采样率不一致时使用 """
+    if src_rate == dst_rate or len(samples) == 0:
+        return samples
+    frames = samples[:len(samples) - len(samples) % channels].reshape(-1, channels)
+    count = int(round(len(frames) * dst_rate / src_rate))
+    positions = np.arange(count, dtype=np.float64) * (src_rate / dst_rate)
+    source = np.arange(len(frames), dtype=np.float64)
+    out = np.empty((count, channels), dtype=np.int16)
+    for channel in range(channels):
+        out[:, channel] = np.interp(positions, source, frames[:, channel])
+    return out.reshape(-1)
+
+
+class SpilledClip(Spilled):
+    """ 写到临时文件的 PCMClip，播放线程取出时读回内存并删除文件 """
+
+    def __init__(self, path, sample_rate, channels):
+        super().__init__(path)
+        self.sample_rate = sample_rate
+        self.channels = channels
+
+    def load(self) -> PCMClip:
+        samples = np.fromfile(self.path, dtype=np.int16)
+        self.discard()
+        return PCMClip(samples, self.sample_rate, self.channels)
+
+
+def spill_clip(item):
+    """ 音频队列满时把整句写到磁盘；流式音频还在下载，不能写出，返回 None """
+    if not isinstance(item, PCMClip):
+        return None
+    fd, path = tempfile.mkstemp(suffix=".pcm")
+    with os.fdopen(fd, "wb") as f:
+        item.samples.astype(np.int16, copy=False).tofile(f)
+    return SpilledClip(path, item.sample_rate, item.channels)
+
+
+class ClipStitcher:
+    """
+        句子之间的拼接：每句的最后 fade_ms 先不播放，等下一句到来时与其开头做等功率交叉淡入淡出，
+        每个采样只播放一次。淡入淡出曲线和混合缓冲区按采样格式预先分配，混合在原地完成。
+        下一句没有及时到来时，用 take_tail() 取出保留的结尾直接播放。
+    """
+
+    def __init__(self, fade_ms=CROSS_FADE_MS):
+        self.fade_ms = fade_ms
+        self.format = None
+        self.fade_len = 0
+        self.tail = None
+        self.fade_in = self.fade_out = None
+        self.mix = self.work = self.scratch = None
+
+    def set_format(self, sample_rate, channels):
+        if self.format == (sample_rate, channels):
+            return
+        self.format = (sample_rate, channels)
+        frames = int(sample_rate * self.fade_ms / 1000)
+        self.fade_len = frames * channels
+        t = np.linspace(0.0, np.pi / 2, frames, dtype=np.float32)[:, None]
+        self.fade_in = np.sin(t)
+        self.fade_out = np.cos(t)
+        self.work = np.empty((frames, channels), dtype=np.float32)
+        self.scratch = np.empty((frames, channels), dtype=np.float32)
+        self.mix = np.empty(self.fade_len, dtype=np.int16)
+        self.tail = None
+
+    def crossfade(self, tail: np.ndarray, head: np.ndarray) -> np.ndarray:
+        """ 等功率交叉淡入淡出，结果写入预分配的 self.mix """
+        channels = self.format[1]
+        work, scratch = self.work, self.scratch
+        np.multiply(head.reshape(-1, channels), self.fade_in, out=work)
+        np.multiply(tail.reshape(-1, channels), self.fade_out, out=scratch)
+        np.add(work, scratch, out=work)
+        np.clip(work, -32768, 32767, out=work)
+        np.copyto(self.mix, work.reshape(-1), casting="unsafe")
+        return self.mix
+
+    def stitch(self, samples: np.ndarray):
+        """ 返回现在要播放的若干段；self.mix 会被下一次调用覆盖，需在此之前写出 """
+        pieces = []
+        fade_len = self.fade_len
+        if fade_len == 0 or len(samples) < 2 * fade_len:
+            # 太短的句子不做衔接
+            if self.tail is not None:
+                pieces.append(self.tail)
+                self.tail = None
+            pieces.append(samples)
+            return pieces
+        start = 0
+        if self.tail is not None:
+            pieces.append(self.crossfade(self.tail, samples[:fade_len]))
+            start = fade_len
+        pieces.append(samples[start:len(samples) - fade_len])
+        self.tail = samples[len(samples) - fade_len:]
+        return pieces
+
+    def take_tail(self):
+        tail, self.tail = self.tail, None
+        return tail
+
+    def reset(self):
+        self.tail = None
+
+
+class PCMStream:
+    """
+        TTS 流式合成的一句话。合成线程收到数据就 write()，结束时 close()；
+        播放线程用 read() 边收边播，不必等整句下载完。
+    """
+
+    def __init__(self, sample_rate=RATE, channels=1, sample_width=2):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.chunks = queue.Queue()
+        self.closed = False
+
+    @property
+    def frame_width(self) -> int:
+        return self.channels * self.sample_width
+
+    def write(self, data):
+        if data and not self.closed:
+            self.chunks.put(bytes(data))
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.chunks.put(b"")  # 结束标志
+
+    def read(self, timeout=None):
+        """ 返回一块 PCM；结束时返回 b""，超时返回 None """
+        try:
+            return self.chunks.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class RingBuffer:
+    """
+        预分配的 int16 环形缓冲区，单生产者（播放线程 write）单消费者（PyAudio 回调 read_into）。
+        读写位置各自只由一方修改，回调中不加锁；清空请求由回调在下一个周期执行。
+    """
+
+    def __init__(self, capacity):
+        self.buffer = np.zeros(capacity, dtype=np.int16)
+        self.capacity = capacity
+        self.read_pos = 0   # 只由消费者修改
+        self.write_pos = 0  # 只由生产者修改
+        self.clear_requested = False
+        self.space = threading.Event()  # 回调读出数据后置位，唤醒等待空间的生产者
+
+    @property
+    def available(self) -> int:
+        return self.write_pos - self.read_pos
+
+    def write(self, samples: np.ndarray) -> int:
+        """ 尽量写入，返回实际写入的采样数 """
+        count = min(len(samples), self.capacity - self.available)
+        if count <= 0:
+            return 0
+        start = self.write_pos % self.capacity
+        first = min(count, self.capacity - start)
+        self.buffer[start:start + first] = samples[:first]
+        self.buffer[:count - first] = samples[first:count]
+        self.write_pos += count
+        return count
+
+    def read_into(self, out: np.ndarray) -> int:
+        """ 填满 out，数据不够的部分补零，返回实际读出的采样数 """
+        if self.clear_requested:
+            self.read_pos = self.write_pos
+            self.clear_requested = False
+        count = min(len(out), self.available)
+        start = self.read_pos % self.capacity
+        first = min(count, self.capacity - start)
+        out[:first] = self.buffer[start:start + first]
+        out[first:count] = self.buffer[:count - first]
+        out[count:] = 0
+        self.read_pos += count
+        self.space.set()
+        return count
+
+    def clear(self):
+        self.clear_requested = True
+        self.space.set()
 
 
 class AudioPlayer():
-    def __init__(self, audio_queue: queue.Queue):
+    def __init__(self, audio_queue: queue.Queue, sample_rate=None, trim=True):
+        """ sample_rate 为空时输出流跟随 TTS 的采样率；指定时固定输出采样率，不一致的音频重采样 """
         self.audio_queue = audio_queue
+        self.fixed_rate = sample_rate
+        self.trim = trim
         self.stop_event = threading.Event()  # Event to stop the thread
-        self.lock = threading.Lock()  # Lock to synchronize audio playback
+        self.started = threading.Event()  # start() 时置位，停止期间播放线程在此等待
+        self.lock = threading.Lock()  # Lock to synchronize stream reopening
+        self.flush_generation = 0  # flush() 时递增，正在写出的片段据此中止
+        self.stitcher = ClipStitcher()  # 只在播放线程中使用
+        self.stream_rate = sample_rate or RATE
+        self.stream_channels = 1
+        self.producing = False  # 播放线程正在输出一句话，此时缓冲区读空算作欠载
+        # 回调统计
+        self.periods = 0
+        self.underruns = 0
+        self.fill_total = 0
+        self.fill_min = None
 
         # Initialize PyAudio
         self.p = pyaudio.PyAudio()
-        self.stream = self.p.open(
-            format=pyaudio.paInt16,
-            channels=1,
-            rate=RATE,
-            output=True,
-            start=False  # Do not start the stream immediately
-        )
+        self.stream = self.open_stream(self.stream_rate, 1)
 
         # Start the audio playback thread
         self.play_audio_thread = threading.Thread(
             target=self.play_audio_process, daemon=True)
         self.play_audio_thread.start()
 
+    def open_stream(self, rate, channels, start=False):
+        # 缓冲区和回调用的周期缓冲随采样格式预先分配
+        self.ring = RingBuffer(int(rate * RING_SECONDS) * channels)
+        self.period = np.zeros(CHUNK_SIZE * channels, dtype=np.int16)
+        return self.p.open(
+            format=pyaudio.paInt16,
+            channels=channels,
+            rate=rate,
+            output=True,
+            frames_per_buffer=CHUNK_SIZE,
+            stream_callback=self.callback,
+            start=start  # Do not start the stream immediately
+        )
+
+    def callback(self, in_data, frame_count, time_info, status):
+        """ PyAudio 回调：每个周期从环形缓冲区取一段，停止时输出静音 """
+        period = self.period
+        if len(period) != frame_count * self.stream_channels:
+            period = np.zeros(frame_count * self.stream_channels, dtype=np.int16)
+        if self.stop_event.is_set():
+            self.ring.clear_requested = True
+            period[:] = 0
+            return (period.tobytes(), pyaudio.paContinue)
+        fill = self.ring.available
+        count = self.ring.read_into(period)
+        self.periods += 1
+        self.fill_total += fill
+        if self.fill_min is None or fill < self.fill_min:
+            self.fill_min = fill
+        if count < len(period) and (count > 0 or self.producing):
+            self.underruns += 1
+        return (period.tobytes(), pyaudio.paContinue)
+
+    def ensure_format(self, sample_rate, channels=1):
+        """ 采样率/声道数跟随 TTS 返回的音频，变化时等缓冲区播完再重新打开输出流 """
+        if sample_rate == self.stream_rate and channels == self.stream_channels:
+            return
+        while self.ring.available > 0 and self.stream.is_active() and not self.stop_event.is_set():
+            self.ring.space.clear()
+            self.ring.space.wait(timeout=IDLE_TIMEOUT)
+        with self.lock:
+            active = self.stream.is_active()
+            self.stream.stop_stream()
+            self.stream.close()
+            self.stream_rate = sample_rate
+            self.stream_channels = channels
+            self.stream = self.open_stream(sample_rate, channels, start=active)
+        print(f"Audio output: {sample_rate}Hz, {channels} channel(s)")
+
     def start(self):
-        if not self.stream.is_active():
-            self.stream.start_stream()  # Start the stream
+        with self.lock:
+            if not self.stream.is_active():
+                self.stream.start_stream()  # Start the stream
 
         self.stop_event.clear()  # Clear the stop event
+        self.started.set()
 
     def stop(self):
+        # 回调在下一个周期开始输出静音，并丢弃缓冲区中的音频
+        self.started.clear()
         self.stop_event.set()  # Set the stop event to stop playback
-        self.stream.stop_stream()  # Stop the stream immediately
-        self.audio_queue.queue.clear()  # Clear the audio queue
+        self.ring.clear()
+        self.clear_queue()  # Clear the audio queue
 
-    def stream_audio(self, audio_segment):
-        with self.lock:  # Ensure thread-safe audio playback
-            try:
-                # Convert AudioSegment to raw audio data
-                raw_data = audio_segment.raw_data
-                # Write raw audio data to the stream
-                if not self.stop_event.is_set() and self.stream.is_active() and raw_data != b'':
-                    self.stream.write(raw_data)
-            except Exception as e:  # Catch potential exceptions during streaming
-                print(f"Error during audio streaming: {e}", file=sys.stderr)
+    def clear_queue(self):
+        if hasattr(self.audio_queue, "clear"):
+            self.audio_queue.clear()
+        else:
+            self.audio_queue.queue.clear()
+
+    def flush(self):
+        """ 打断时调用：清空待播放的音频，已写入缓冲区的部分在下一个周期丢弃 """
+        self.flush_generation += 1
+        self.clear_queue()
+        self.ring.clear()
+        self.stitcher.reset()
+
+    def stream_audio(self, pieces, channels=1, generation=None):
+        """ 依次把若干段 int16 数组写入环形缓冲区，缓冲区满时等待回调取走数据 """
+        if generation is None:
+            generation = self.flush_generation
+        wait = CHUNK_SIZE / self.stream_rate
+        for samples in pieces:
+            offset = 0
+            while offset < len(samples):
+                if self.stop_event.is_set() or generation != self.flush_generation:
+                    return
+                ring = self.ring
+                ring.space.clear()
+                offset += ring.write(samples[offset:])
+                if offset < len(samples):
+                    ring.space.wait(timeout=wait * 2)
+
+    def report(self) -> str:
+        periods = self.periods or 1
+        to_ms = 1000 / (self.stream_rate * self.stream_channels)
+        report = (f"Audio buffer: {self.ring.available * to_ms:.0f}ms buffered, "
+                f"avg fill {self.fill_total / periods * to_ms:.0f}ms, "
+                f"min fill {(self.fill_min or 0) * to_ms:.0f}ms, "
+                f"underruns {self.underruns}/{self.periods} periods")
+        if hasattr(self.audio_queue, "report"):
+            report += f"\n{self.audio_queue.report()}"
+        return report
+
+    def play_pcm_stream(self, pcm_stream, generation):
+        """ 播放流式返回的 PCM，与上一句之间不做交叉淡入淡出 """
+        self.write_tail(generation)
+        rate = self.fixed_rate or pcm_stream.sample_rate
+        self.ensure_format(rate, pcm_stream.channels)
+        while not self.stop_event.is_set() and generation == self.flush_generation:
+            data = pcm_stream.read(timeout=STREAM_READ_TIMEOUT)
+            if data is None:
+                continue
+            if not data:
+                break
+            samples = resample(np.frombuffer(data, dtype=np.int16),
+                               pcm_stream.sample_rate, rate, pcm_stream.channels)
+            self.stream_audio((samples,), pcm_stream.channels, generation)
+
+    def play_clip(self, clip: PCMClip, generation):
+        rate = self.fixed_rate or clip.sample_rate
+        samples = resample(clip.samples, clip.sample_rate, rate, clip.channels)
+        if self.trim:
+            samples = trim_silence(samples, rate, clip.channels)
+        if len(samples) == 0:
+            return
+        if (rate, clip.channels) != (self.stream_rate, self.stream_channels):
+            self.write_tail(generation)
+            self.ensure_format(rate, clip.channels)
+        self.stitcher.set_format(rate, clip.channels)
+        self.stream_audio(self.stitcher.stitch(samples), clip.channels, generation)
+        if generation != self.flush_generation:
+            self.stitcher.reset()  # 播放期间被 flush 则不再衔接
+
+    def write_tail(self, generation):
+        """ 下一句没有紧接着到来，把保留的结尾播完 """
+        tail = self.stitcher.take_tail()
+        if tail is not None and generation == self.flush_generation:
+            self.stream_audio((tail,), self.stream_channels, generation)
 
     def play_audio_process(self):
-        last_segment = None
-        cross_fade_duration = 50  # 50ms cross-fade duration
-        last_segment_tail_length = 50  # 保留上一段音频结尾的50ms数据
         while True:
             if self.stop_event.is_set():
-                # If stop_event is set, do not process the queue
-                time.sleep(0.1)  # Sleep to reduce CPU usage
+                # 停止期间不处理队列，等待 start()
+                self.stitcher.reset()
+                self.started.wait()
                 continue
 
-            if not self.audio_queue.empty():
-                audio_clip = self.audio_queue.get()
-                if audio_clip:
-                    # 确保 audio_clip 是一个类文件对象
-                    if isinstance(audio_clip, BytesIO):
-                        audio_clip.seek(0)  # 确保从头开始读取
-                    # Convert BytesIO to AudioSegment
-                    audio_segment = AudioSegment.from_file(
-                        audio_clip, format="wav")
-
-                    # 如果存在上一个片段，则进行交叉淡入淡出
-                    if last_segment:
-                        # 只保留上一段音频结尾的50ms数据
-                        last_segment_tail = last_segment[-last_segment_tail_length:]
-                        combined_segment = last_segment_tail.append(
-                            audio_segment, crossfade=cross_fade_duration)
-                    else:
-                        combined_segment = audio_segment
-
-                    # 播放合并后的片段
-                    self.stream_audio(combined_segment)
-
-                    # 更新 last_segment 为当前片段
-                    last_segment = audio_segment
-
-                    # 清空已处理的音频片段，避免重复处理
-                    audio_clip.close()
-                # elif audio_clip is None:
-                #     break  # 处理结束标志，退出循环
-
-            # 在空闲时减少CPU占用
-            time.sleep(0.1)  # 适当调整延时时间
+            timeout = IDLE_TIMEOUT
+            if self.stitcher.tail is not None:
+                # 缓冲区快播完时才写出保留的结尾，在此之前下一句到来还能衔接
+                margin = self.ring.available - 2 * len(self.period)
+                timeout = max(0.0, margin / (self.stream_rate * self.stream_channels))
+            try:
+                audio_clip = self.audio_queue.get(timeout=timeout)
+            except queue.Empty:
+                self.write_tail(self.flush_generation)
+                continue
+            if audio_clip is None:
+                break  # 处理结束标志，退出循环
+            generation = self.flush_generation
+            self.producing = True
+            try:
+                if isinstance(audio_clip, PCMStream):
+                    self.play_pcm_stream(audio_clip, generation)
+                elif isinstance(audio_clip, PCMClip) and len(audio_clip.samples):
+                    self.play_clip(audio_clip, generation)
+            finally:
+                self.producing = False
         print("Audio playback has stopped.")
 
-        # Reset last_segment to None when stopping playback
-        self.last_segment = None
-
     def __del__(self):
         # Ensure the stream and PyAudio instance are properly closed when the object is destroyed
         if self.stream and self.stream.is_active():
@@ -108,3 +444,62 @@ class AudioPlayer():
         if self.stream:
             self.stream.close()
         self.p.terminate()
+
+
+def make_test_clip(duration_ms, sample_rate=RATE, silence_ms=200, seed=0) -> np.ndarray:
+    """ 首尾带静音的测试音频，用于基准测试 """
+    rng = np.random.default_rng(seed)
+    frames = int(sample_rate * duration_ms / 1000)
+    silence = int(sample_rate * silence_ms / 1000)
+    t = np.arange(frames - 2 * silence) / sample_rate
+    voice = np.sin(2 * np.pi * 220 * t) * 8000 + rng.normal(0, 500, len(t))
+    clip = np.zeros(frames, dtype=np.int16)
+    clip[silence:frames - silence] = voice.astype(np.int16)
+    return clip
+
+
+def benchmark(sentences=200, sentence_ms=3000, sample_rate=RATE):
+    """ 长回复的拼接耗时：NumPy 拼接 vs 原来基于 pydub 的实现（安装了 pydub 时） """
+    clips = [make_test_clip(sentence_ms, sample_rate, seed=i) for i in range(sentences)]
+    audio_ms = sentences * sentence_ms
+
+    stitcher = ClipStitcher()
+    stitcher.set_format(sample_rate, 1)
+    start = time.perf_counter()
+    output_samples = 0
+    for clip in clips:
+        for piece in stitcher.stitch(trim_silence(clip, sample_rate)):
+            output_samples += len(piece)
+    elapsed = (time.perf_counter() - start) * 1000
+    print(f"numpy: {sentences} x {sentence_ms}ms clips stitched in {elapsed:.1f}ms "
+          f"({elapsed / sentences:.3f}ms per clip, {elapsed / audio_ms * 100:.4f}% of audio time), "
+          f"{output_samples / sample_rate:.1f}s output")
+
+    start = time.perf_counter()
+    resample(np.concatenate(clips[:10]), 24000, sample_rate)
+    print(f"numpy: resampled {10 * sentence_ms}ms from 24000Hz in {(time.perf_counter() - start) * 1000:.1f}ms")
+
+    try:
+        from pydub import AudioSegment
+    except ImportError:
+        print("pydub not installed, skipping the pydub comparison")
+        return
+    segments = [AudioSegment(clip.tobytes(), frame_rate=sample_rate, sample_width=2, channels=1)
+                for clip in clips]
+    start = time.perf_counter()
+    last_segment = None
+    for segment in segments:
+        if last_segment:
+            combined = last_segment[-CROSS_FADE_MS:].append(
+                segment, crossfade=CROSS_FADE_MS)
+        else:
+            combined = segment
+        combined.raw_data
+        last_segment = segment
+    elapsed = (time.perf_counter() - start) * 1000
+    print(f"pydub: {sentences} x {sentence_ms}ms clips stitched in {elapsed:.1f}ms "
+          f"({elapsed / sentences:.3f}ms per clip)")
+
+
+if __name__ == "__main__":
+    benchmark()